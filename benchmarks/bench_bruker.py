@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Synthetic Bruker RAW v3 generator and throughput benchmark of the Bruker
+# reading/conversion path (parse, convert_raw_to_uxd, get_Bruker, get_Bruker_raw)
+#
+# usage :
+# python bench_bruker.py                       # run, compare with the saved baseline
+# python bench_bruker.py --ranges 600 --steps 1024 --save   # run and store as new baseline
+# python bench_bruker.py --make test.raw       # only write a synthetic file
+#
+# every stage runs in its own process, so that the reported peak RSS
+# (ru_maxrss of that process) belongs to that stage only
+
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+
+try:
+	from RSM_Viewer import Bruker
+except ImportError:
+	sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+	import Bruker
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline_bruker.json')
+
+def make_raw(fn, ranges=100, steps=1024, supplement=0, drive=129, status=1, seed=0):
+	""" Write a valid RAW1.01 file of an omega/2theta PSD map (drive code 129 by default):
+	ranges: number of ranges, steps: points per range (int or one value per range),
+	supplement: size in bytes of the supplementary header of each range.
+	Headers are packed with the same structured dtypes the parser uses.
+	"""
+	ds = Bruker.DatasetDiffractPlusV3
+	rng = np.random.RandomState(seed)
+	if np.isscalar(steps):
+		steps = [steps]*ranges
+	with open(fn, 'wb') as f:
+		hdr = np.zeros(1, ds.file_header_dtype)
+		hdr['_FILE_STATUS_CODE'] = status
+		hdr['RANGE_CNT'] = ranges
+		hdr['DATE'] = '01/01/15'
+		hdr['TIME'] = '00:00:00'
+		hdr['USER'] = 'bench'
+		hdr['SAMPLE'] = 'synthetic'
+		hdr['GNONIOMETER_RADIUS'] = 217.5
+		hdr['ANODE_MATERIAL'] = 'Cu'
+		hdr['WL1'] = 1.5406
+		hdr['WL2'] = 1.54439
+		hdr['WL_UNIT'] = 'A'
+		buf = bytearray(ds.FILE_HEADER_LENGTH)
+		buf[:ds.file_header_dtype.itemsize] = hdr.tostring()
+		buf[:7] = 'RAW1.01'
+		f.write(buf)
+		header_length = 304
+		for i in range(ranges):
+			rh = np.zeros(1, ds.range_header_dtype)
+			rh['HEADER_LENGTH'] = header_length
+			rh['STEPS'] = steps[i]
+			rh['OMEGA'] = 30. + 0.01*i
+			rh['TWOTHETA'] = 60.
+			rh['SCAN_MODE'] = 1
+			rh['STEP_SIZE'] = 0.0123
+			rh['STEPTIME'] = 1.
+			rh['_STEPPING_DRIVE_CODE'] = drive
+			rh['KV'] = 40
+			rh['MA'] = 40
+			rh['RANGE_WL'] = 1.5406
+			rh['_DATUM_LENGTH'] = 4
+			rh['SUPPLEMENT_HEADER_SIZE'] = supplement
+			f.write(rh.tostring())
+			f.write('\0'*(header_length - ds.range_header_dtype.itemsize + supplement))
+			f.write(rng.poisson(100, steps[i]).astype('<f4').tostring())
+
+def _parse(raw, uxd, tmp):
+	Bruker.DatasetDiffractPlusV3(open(raw, 'rb'))
+
+def _parse_mmap(raw, uxd, tmp):
+	Bruker.DatasetDiffractPlusV3(open(raw, 'rb'), use_mmap=True)
+
+def _convert_raw_to_uxd(raw, uxd, tmp):
+	Bruker.convert_raw_to_uxd(raw, tmp)
+
+def _get_Bruker(raw, uxd, tmp):
+	Bruker.get_Bruker(uxd)
+
+def _get_Bruker_raw(raw, uxd, tmp):
+	Bruker.get_Bruker_raw(raw)
+
+# name, function, input file measured for MB/s
+STAGES = [
+	('parse',              _parse,              'raw'),
+	('parse_mmap',         _parse_mmap,         'raw'),
+	('convert_raw_to_uxd', _convert_raw_to_uxd, 'raw'),
+	('get_Bruker',         _get_Bruker,         'uxd'),
+	('get_Bruker_raw',     _get_Bruker_raw,     'raw'),
+]
+
+def _run_stage(func, raw, uxd, tmp, queue):
+	t = time.time()
+	func(raw, uxd, tmp)
+	dt = time.time() - t
+	# ru_maxrss is in kB on Linux, in bytes on Mac OS
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == 'darwin':
+		rss /= 1024.
+	queue.put((dt, rss/1024.))
+
+def run(ranges=100, steps=1024, supplement=0, repeat=3, stages=None, verbose=True):
+	""" Time each stage on a synthetic file, best of repeat runs.
+	return: {stage: {"seconds", "MB/s", "ranges/s", "peak_rss_MB"}}
+	"""
+	tmpdir = tempfile.mkdtemp(prefix='bench_bruker')
+	try:
+		raw = os.path.join(tmpdir, 'bench.raw')
+		uxd = os.path.join(tmpdir, 'bench.uxd')
+		make_raw(raw, ranges, steps, supplement)
+		Bruker.convert_raw_to_uxd(raw, uxd)
+		sizes = {'raw': os.path.getsize(raw), 'uxd': os.path.getsize(uxd)}
+		results = {}
+		for name, func, src in STAGES:
+			if stages and name not in stages:
+				continue
+			best_t, best_rss = None, None
+			for r in range(repeat):
+				queue = multiprocessing.Queue()
+				p = multiprocessing.Process(target=_run_stage, args=(func, raw, uxd, os.path.join(tmpdir, 'out.uxd'), queue))
+				p.start()
+				dt, rss = queue.get()
+				p.join()
+				best_t = dt if best_t is None else min(best_t, dt)
+				best_rss = rss if best_rss is None else min(best_rss, rss)
+			results[name] = {"seconds": best_t,
+				"MB/s": sizes[src]/1048576./best_t,
+				"ranges/s": ranges/best_t,
+				"peak_rss_MB": best_rss}
+			if verbose:
+				print "%-20s %8.3f s %9.1f MB/s %10.1f ranges/s %8.1f MB peak RSS"%(name, best_t, results[name]["MB/s"], results[name]["ranges/s"], best_rss)
+		return results
+	finally:
+		shutil.rmtree(tmpdir)
+
+def compare(results, baseline, tolerance=0.2):
+	""" Names of the stages slower (or using more memory) than baseline by more than tolerance (fraction) """
+	regressions = []
+	for name, r in results.items():
+		b = baseline.get(name)
+		if b is None:
+			continue
+		if r["seconds"] > b["seconds"]*(1+tolerance):
+			regressions.append("%s: %.3f s, baseline %.3f s"%(name, r["seconds"], b["seconds"]))
+		if r["peak_rss_MB"] > b["peak_rss_MB"]*(1+tolerance):
+			regressions.append("%s: %.1f MB peak RSS, baseline %.1f MB"%(name, r["peak_rss_MB"], b["peak_rss_MB"]))
+	return regressions
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Benchmark of the Bruker RAW reading and conversion path")
+	parser.add_argument("--ranges", type=int, default=100, help="number of ranges (default: 100)")
+	parser.add_argument("--steps", type=int, default=1024, help="steps per range (default: 1024)")
+	parser.add_argument("--supplement", type=int, default=0, help="supplementary header size in bytes (default: 0)")
+	parser.add_argument("--repeat", type=int, default=3, help="runs per stage, the best one is kept (default: 3)")
+	parser.add_argument("--stage", action="append", help="only run this stage (can be repeated)")
+	parser.add_argument("--baseline", default=BASELINE, help="baseline file (default: %(default)s)")
+	parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+	parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before reporting a regression (default: 0.2)")
+	parser.add_argument("--make", metavar="RAW", help="only write a synthetic RAW file with the given size parameters")
+	args = parser.parse_args(argv)
+
+	if args.make:
+		make_raw(args.make, args.ranges, args.steps, args.supplement)
+		return 0
+
+	key = "%dx%d+%d"%(args.ranges, args.steps, args.supplement)
+	results = run(args.ranges, args.steps, args.supplement, args.repeat, args.stage)
+	baselines = {}
+	if os.path.isfile(args.baseline):
+		with open(args.baseline) as f:
+			baselines = json.load(f)
+	if args.save:
+		baselines[key] = results
+		with open(args.baseline, 'w') as f:
+			json.dump(baselines, f, indent=1, sort_keys=True)
+		print "Baseline saved for %s in %s"%(key, args.baseline)
+		return 0
+	if key not in baselines:
+		print "No baseline for %s, run with --save to create one"%key
+		return 0
+	regressions = compare(results, baselines[key], args.tolerance)
+	for r in regressions:
+		print "REGRESSION", r
+	return 1 if regressions else 0
+
+if '__main__' == __name__:
+	sys.exit(main())
@@ -13,6 +13,7 @@
 # convert_raw_to_uxd('infile.raw', 'output.uxd')
 
 import os
+import mmap
 import struct
 import copy 
 import types
@@ -20,6 +21,23 @@ import collections
 from cStringIO import StringIO
 import numpy as np
 
+#
+# struct codes of the header description tables and their numpy equivalent
+# (raw files are little endian)
+#
+_dtype_codes = { 'I' : '<u4', 'f' : '<f4', 'd' : '<f8', 'c' : 'u1' }
+
+def desc_tbl_dtype( tbl ):
+	'''compile a (name, type, start, len) description table into a numpy
+	structured dtype, so a whole header decodes with a single frombuffer'''
+	names, formats, offsets = [], [], []
+	for (k,t,s,l) in tbl :
+		names.append( k )
+		formats.append( 'S%d' % l if 'str' == t else _dtype_codes[t] )
+		offsets.append( s )
+	itemsize = max( s + l for (k,t,s,l) in tbl )
+	return np.dtype( { 'names' : names, 'formats' : formats, 'offsets' : offsets, 'itemsize' : itemsize } )
+
 #
 # this implements a ordered user dictionary , 
 # serves as an interface for (read-)accessing _metadata using dictionary syntax
@@ -62,8 +80,12 @@ class Scan(Metadata):
 		Metadata.__init__(self)
 		
 		self.data = []# array.array('f')          # holding scan data
+		self.xdata = None # numpy columns, filled instead of data by the mmap decoder
+		self.ydata = None
 
 	def __len__(self):
+		if self.ydata is not None:
+			return len(self.ydata)
 		return len(self.data)
 
 	def __repr__(self):
@@ -72,22 +94,137 @@ class Scan(Metadata):
 	def __str__(self):
 		return self.pretty_format()
 
+	# number of data lines formatted per write() call
+	WRITE_CHUNK = 8192
+
 	def pretty_format(self, print_header = True):
 		import StringIO
 		out = StringIO.StringIO()
+		self.write(out, print_header)
+		return out.getvalue()
+
+	def write(self, out, print_header = True):
+		'''write the scan as UXD text to the file-like out, data formatted in bulk'''
 		# meta data
 		if print_header :
-			for k,v in self._metadata.items() :
+			for k,v in self.items() :
 				if types.FloatType == type(v) :
 					print >>out, "_{0:<15} = {1:.6f}".format(k,v)
 				else:
 					print >>out, "_{0:<15} = {1}".format(k,v)
 
-		# print scan data
-		if self.data:
-			for (x,y) in self.data:
-				print >> out ,  "{0:.6f}\t{1:.6f}".format(x,y)
-		return out.getvalue()
+		# print scan data, '%.6f' gives the same text as '{0:.6f}'
+		x, y = self.columns()
+		for i in xrange(0, len(y), self.WRITE_CHUNK):
+			xy = np.empty( (len(y[i:i+self.WRITE_CHUNK]), 2), dtype = np.float64 )
+			xy[:,0] = x[i:i+self.WRITE_CHUNK]
+			xy[:,1] = y[i:i+self.WRITE_CHUNK]
+			out.write( ( "%.6f\t%.6f\n" * len(xy) ) % tuple( xy.ravel() ) )
+
+	def items(self):
+		return self._metadata.items()
+
+	def columns(self):
+		'''return (x, y) as numpy arrays, whichever way the scan was decoded'''
+		if self.ydata is not None:
+			return self.xdata, self.ydata
+		if not self.data:
+			return np.zeros(0), np.zeros(0)
+		xy = np.asarray(self.data, dtype=np.float64)
+		return xy[:,0], xy[:,1]
+
+#
+# scan whose range header is one row of a structured array shared by the
+# whole dataset (DatasetDiffractPlusV3.range_headers) ; only keys that are
+# not part of the binary header end up in _metadata
+#
+class RangeScan(Scan):
+	def __init__(self, headers, seq, drives, row = None):
+		self._metadata = {}
+		self.data = []
+		self.xdata = None
+		self.ydata = None
+		self._headers = headers # the structured array, not the row: rows are copied on access
+		self._seq = seq
+		self._row = seq if row is None else row # row of this range in headers
+		self._drives = drives   # tbl_stepping_drives of the dataset
+
+	def __getitem__( self, key ):
+		if key in self._metadata:
+			return self._metadata[ key ]
+		if 'SEQ' == key:
+			return self._seq
+		if 'TYPE' == key:
+			return self._drives[ self['_STEPPING_DRIVE_CODE'] ][0]
+		if 'STEPPING_DRIVE' == key:
+			return self._drives[ self['_STEPPING_DRIVE_CODE'] ][1]
+		if key in self._headers.dtype.fields:
+			return self._headers[ key ][ self._row ].item()
+		raise KeyError( key )
+
+	def __getattr__(self, key):
+		try:
+			return self[ key ]
+		except KeyError:
+			raise AttributeError('Key\'%s\' does not exists' % key)
+
+	def items(self):
+		# same order as the per-field decoder: SEQ, table fields, TYPE, STEPPING_DRIVE
+		keys = [ 'SEQ' ] + list( self._headers.dtype.names ) + [ 'TYPE', 'STEPPING_DRIVE' ]
+		keys += [ k for k in self._metadata if k not in keys ]
+		return [ (k, self[k]) for k in keys ]
+
+#
+# list-like access to the ranges of a mapped raw file, used as
+# DatasetDiffractPlusV3.scans in lazy mode : range offsets are only walked as
+# far as the requested range and a range is decoded when it is accessed
+#
+class LazyRanges(object):
+	def __init__(self, ds, mapped, count):
+		self._ds = ds
+		self._mapped = mapped
+		self._count = count
+		self._offsets = []                     # offsets of the ranges walked so far
+		self._next = ds.FILE_HEADER_LENGTH     # where the next unwalked range starts
+		self._headers = None                   # full header table, once built
+
+	def __len__(self):
+		return self._count
+
+	def __iter__(self):
+		for i in xrange( self._count ):
+			yield self[i]
+
+	def __getitem__(self, i):
+		if isinstance( i, slice ):
+			return [ self[j] for j in xrange( *i.indices( self._count ) ) ]
+		if i < 0:
+			i += self._count
+		if not 0 <= i < self._count:
+			raise IndexError( 'range index out of range' )
+		offset = self.offset( i )
+		headers = self._ds._decode_range_headers( self._mapped, np.array( [offset] ) )
+		return self._ds._make_scan( self._mapped, headers, i, offset, row = 0 )
+
+	def offset(self, i):
+		'''byte offset of range i, walking the headers up to it if needed'''
+		if i >= len( self._offsets ):
+			walked, self._next = self._ds._range_offsets( self._mapped, i + 1 - len( self._offsets ), self._next )
+			self._offsets.extend( walked )
+		return self._offsets[i]
+
+	def headers(self, stop = None):
+		'''structured array of the headers of ranges [0, stop)'''
+		if stop is None or stop > self._count:
+			stop = self._count
+		if self._headers is not None:
+			return self._headers[:stop]
+		if stop > 0:
+			self.offset( stop - 1 )
+		headers = self._ds._decode_range_headers( self._mapped, np.array( self._offsets[:stop], dtype = np.int64 ) )
+		if stop == self._count:
+			self._headers = headers
+		return headers
 	
 
 		
@@ -115,6 +252,11 @@ class Dataset(Metadata):
 		'''print dataset's header(optional) and each scan'''
 		import StringIO
 		out = StringIO.StringIO()
+		self.write(out, print_header)
+		return out.getvalue()
+
+	def write(self, out, print_header = True ):
+		'''stream dataset's header(optional) and each scan to the file-like out'''
 
 		# print dataset header if told so
 		if print_header:
@@ -127,11 +269,8 @@ class Dataset(Metadata):
 		for i in range( len(self.scans) ) :
 			if print_header:
 				out.write( "\n; ( Data for Range number {0:d} )\n".format(i) )
-			out.write( self.scans[i].pretty_format(print_header) + "\n" )
-			pass
-		
-		
-		return out.getvalue()
+			self.scans[i].write(out, print_header)
+			out.write( "\n" )
 
 						
 
@@ -144,8 +283,12 @@ class Dataset(Metadata):
 		pass
 
 	def merge( self, foreign ):
-		c = copy.deepcopy(self)
-		c.scans.extend( foreign.scans )
+		'''new dataset with the scans of self followed by those of foreign ;
+		the scans are shared with both datasets, not copied'''
+		c = self.__class__()
+		c.__dict__.update( self.__dict__ )
+		c._metadata = copy.copy( self._metadata )
+		c.scans = list( self.scans ) + list( foreign.scans )
 		return c
 	
 	
@@ -225,6 +368,10 @@ class DatasetDiffractPlusV3( Dataset ):
 			( '_DATUM_LENGTH',       'I',      252,  4 ),
 			( 'SUPPLEMENT_HEADER_SIZE','I',  256, 4 ) # 256
 			]   # end of range_header_desc_tbl
+	
+	# compiled tables, see desc_tbl_dtype
+	file_header_dtype = desc_tbl_dtype( file_header_desc_tbl )
+	range_header_dtype = desc_tbl_dtype( range_header_desc_tbl )
 			
 	tbl_stepping_drives = {
 		0 : ( "locked coupled" , "TWOTHETA" ),
@@ -245,9 +392,17 @@ class DatasetDiffractPlusV3( Dataset ):
 		130 : ( "psd fast scan" "TWOTHETA" )
 		}
 
-	def __init__(self, ifh = None ):
+	def __init__(self, ifh = None, use_mmap = False, lazy = False ):
 		Dataset.__init__( self )
 		self.scans =  [] # a list of scans
+		# use_mmap : map the file instead of copying it, and hand out the
+		# intensities of each range as float32 views (Scan.xdata/ydata)
+		self.use_mmap = use_mmap
+		# lazy : map the file, read the file header only and decode ranges
+		# when they are accessed ; self.scans is then a LazyRanges
+		self.lazy = lazy
+		# structured array of all range headers, one row per range (mmap mode only)
+		self.range_headers = None
 		if ifh:
 			ifh.seek(0,0)
 			self.parse( ifh )
@@ -265,29 +420,66 @@ class DatasetDiffractPlusV3( Dataset ):
 		return is_rawfile and is_v3
 	
 
+	def merge( self, foreign ):
+		c = Dataset.merge( self, foreign )
+		# only the small header tables are concatenated, intensities stay views into the mapped files
+		if self.range_headers is not None and getattr( foreign, 'range_headers', None ) is not None:
+			c.range_headers = np.concatenate( ( self.range_headers, foreign.range_headers ) )
+		else:
+			c.range_headers = None
+		return c
+
+	def rsm_arrays(self, sort = False):
+		'''{"omega", "tth", "data"} arrays as returned by get_Bruker : 2D (one row
+		per range), or concatenated with "offsets" if the ranges have different
+		numbers of steps (see ragged_to_2d)
+		sort : order the ranges by increasing omega, e.g. after merging sessions'''
+		order = np.arange( len( self.scans ) )
+		omega_r = self.range_column( 'OMEGA' )
+		if sort:
+			order = np.argsort( omega_r, kind = 'mergesort' )
+		steps = self.range_column( 'STEPS' )[order].astype( np.int64 )
+		offsets = np.zeros( len(order) + 1, dtype = np.int64 )
+		np.cumsum( steps, out = offsets[1:] )
+		omega = np.repeat( omega_r[order].astype( np.float64 ), steps )
+		tth = np.empty( offsets[-1] )
+		intensity = np.empty( offsets[-1] )
+		for j in range( len(order) ):
+			tth[offsets[j]:offsets[j+1]], intensity[offsets[j]:offsets[j+1]] = self.scans[ order[j] ].columns()
+		return ragged_to_2d( {"omega":omega, "tth":tth, "data":intensity, "offsets":offsets} )
+
+	# value of a range header field for every range (or the first stop ones), as a numpy array
+	def range_column(self, key, stop = None):
+		if key in self.range_header_dtype.fields:
+			if isinstance( self.scans, LazyRanges ):
+				return self.scans.headers( stop )[ key ]
+			if self.range_headers is not None:
+				return self.range_headers[ key ][:stop]
+		return np.array( [ scn[key] for scn in self.scans[:stop] ] )
+
 	# determin_dataset_type and set stepping_drive1,2 
 	def determin_dataset_type(self):
 		
 		if len( self.scans ) < 1 :
 			raise Exception( "Empty Dataset" )
 			
+		codes = self.range_column( '_STEPPING_DRIVE_CODE', 2 )
 		if len( self.scans ) == 1 : 
 			self['TYPE'] = 'SingleScanPlot'
-			t = self.scans[0]['_STEPPING_DRIVE_CODE']
+			t = codes[0]
 			self['SCAN_TYPE'], self['STEPPING_DRIVE1'] = self.tbl_stepping_drives[t]
 			return
 		
-		a = self.scans[0]
-		b = self.scans[1]
+		a, b = codes[0], codes[1]
 		
-		if not a['TYPE'] == b['TYPE'] :
+		if not self.tbl_stepping_drives[a][0] == self.tbl_stepping_drives[b][0] :
 			raise Exception( " Donno how to deal with this kinds of scan " )
 		
-		if a['_STEPPING_DRIVE_CODE'] in [13] :
+		if a in [13] :
 			raise Exception( " Donno how to deal with this kinds of scan " )
 			
 		# PSD scans
-		if a['_STEPPING_DRIVE_CODE'] in [129, 130] :
+		if a in [129, 130] :
 			self['TYPE'] = 'RSMPlot'
 			self['STEPPING_DRIVE1'] = 'OMEGA'
 			self['STEPPING_DRIVE2'] = 'TWOTHETA'
@@ -298,14 +490,117 @@ class DatasetDiffractPlusV3( Dataset ):
 		# so that it is safe to say for 2d scan
 		self['TYPE'] = 'TwoDPlot'
 		for drv in [ 'KHI', 'PHI', 'X', 'Y', 'Z','AUX1','AUX2','AUX3' ]:
-			if a[drv] != b[drv]:
+			col = self.range_column( drv, 2 )
+			if col[0] != col[1]:
 				self['STEPPING_DRIVE1'] = drv
-				self['STEPPING_DRIVE2'] = a['STEPPING_DRIVE']
+				self['STEPPING_DRIVE2'] = self.tbl_stepping_drives[a][1]
 		
 		
 		
 		pass
+
+	def _set_file_status(self):
+		if   1 == self['_FILE_STATUS_CODE'] :
+			self['FILE_STATUS'] = "done"
+		elif 2 == self['_FILE_STATUS_CODE'] :
+			self['FILE_STATUS'] = "active"
+		elif 3 == self['_FILE_STATUS_CODE'] :
+			self['FILE_STATUS'] = "aborted"
+		elif 4 == self['_FILE_STATUS_CODE'] :
+			self['FILE_STATUS'] = "interrupted"
+
+	def _map_file(self, ifh):
+		'''return (seekable file, buffer) over the whole content of ifh
+
+		a real file is memory-mapped read-only, anything else (pipes,
+		StringIO, empty files) is copied into memory
+		'''
+		try:
+			f = mmap.mmap( ifh.fileno(), 0, access = mmap.ACCESS_READ )
+			return f, f
+		except (AttributeError, IOError, ValueError, mmap.error):
+			f = StringIO( ifh.read() )
+			return f, f.getvalue()
+
+	def _range_offsets(self, mapped, count, range_start = FILE_HEADER_LENGTH, size = None ):
+		'''walk count range headers from range_start, return the byte offset
+		of each range and the offset following the last one
+
+		if size is given, the walk stops before the first range that is not
+		completely written within the first size bytes (file being acquired)'''
+		supplement_pos = self.range_header_dtype.fields['SUPPLEMENT_HEADER_SIZE'][1]
+		offsets = np.empty( count, dtype = np.int64 )
+		for i in range( count ):
+			if size is not None and range_start + self.range_header_dtype.itemsize > size:
+				return offsets[:i], range_start
+			header_length, steps = struct.unpack_from( '<II', mapped, range_start )
+			supplement, = struct.unpack_from( '<I', mapped, range_start + supplement_pos )
+			range_end = range_start + header_length + supplement + 4 * steps
+			if size is not None and ( 0 == header_length or range_end > size ):
+				return offsets[:i], range_start
+			offsets[i] = range_start
+			range_start = range_end
+		return offsets, range_start
+
+	def _check_range_headers(self, headers):
+		# some constraint described in file-exchange help file
+		assert ( headers['_VARYINGPARAMS'] == 0 ).all(),"non-conforming file format: more than 1 varying parameters in one range " 
+		assert ( headers['_DATUM_LENGTH'] == 4 ).all(),"non-conforming file format : datum length more than 4 byte " 
+		assert not np.in1d( headers['_STEPPING_DRIVE_CODE'], [9,10,11] ).any() , "non-conforming file format, using AUX* drives" 
+
+	def _make_scan(self, mapped, headers, seq, range_start, row = None):
+		'''RangeScan for the range starting at range_start, with its
+		intensities as a view into mapped'''
+		scn = RangeScan( headers, seq, self.tbl_stepping_drives, row )
+		n = scn['STEPS']
+		data_start = range_start + scn['HEADER_LENGTH'] + scn['SUPPLEMENT_HEADER_SIZE']
+		scn.ydata = np.frombuffer( mapped, dtype = '<f4', count = n, offset = int(data_start) )
+		scn.xdata = self._step_axis( scn[scn['STEPPING_DRIVE']], scn['STEP_SIZE'], n )
+		return scn
+
+	def _decode_range_headers(self, mapped, offsets):
+		'''decode the headers of the ranges starting at offsets into one structured array'''
+		dt = self.range_header_dtype
+		raw = np.frombuffer( mapped, dtype = np.uint8 )
+		rows = raw[ offsets[:,np.newaxis] + np.arange( dt.itemsize ) ]
+		headers = rows.view( dt ).reshape( len(offsets) )
+		self._check_range_headers( headers )
+		return headers
+
+	def _step_axis(self, x, xstep, n):
+		'''positions of the stepping drive: start + arange(n)*step, but
+		accumulated the same way as the per-step decoder so that both
+		agree to the last bit'''
+		xdata = np.empty( n, dtype = np.float64 )
+		xdata[:1] = x
+		xdata[1:] = xstep
+		return np.add.accumulate( xdata, out = xdata )
+
+	def _parse_mapped(self, ifh ):
+		f, mapped = self._map_file( ifh )
+		
+		# valid file type signature
+		if not self.validate(f):
+			raise Exception("The file format is not of 'diffract plus raw file version 3'.")
+		
+		hdr = np.frombuffer( mapped, dtype = self.file_header_dtype, count = 1 )[0]
+		for (k,t,s,l) in self.file_header_desc_tbl :
+			self[k] = hdr[k].item()
+		self._set_file_status()
+		
+		if self.lazy:
+			self.scans = LazyRanges( self, mapped, self['RANGE_CNT'] )
+			return
+		
+		offsets, end = self._range_offsets( mapped, self['RANGE_CNT'] )
+		self.range_headers = self._decode_range_headers( mapped, offsets )
+		for i in range( len(offsets) ):
+			self.scans.append( self._make_scan( mapped, self.range_headers, i, offsets[i] ) )
+
 	def parse(self, ifh ):
+		if self.use_mmap or self.lazy:
+			return self._parse_mapped( ifh )
+		
 		# read into seekable buffer
 		f = StringIO( ifh.read() )
 		f.seek( 0 , os.SEEK_SET )
@@ -327,15 +622,7 @@ class DatasetDiffractPlusV3( Dataset ):
 			else:
 				self[k] = struct.unpack(t,buf)[0]
 
-		if   1 == self['_FILE_STATUS_CODE'] :
-			self['FILE_STATUS'] = "done"
-		elif 2 == self['_FILE_STATUS_CODE'] :
-			self['FILE_STATUS'] = "active"
-		elif 3 == self['_FILE_STATUS_CODE'] :
-			self['FILE_STATUS'] = "aborted"
-		elif 4 == self['_FILE_STATUS_CODE'] :
-			self['FILE_STATUS'] = "interrupted"
-
+		self._set_file_status()
 		
 		# beginning of first range
 		f.seek(self.FILE_HEADER_LENGTH, os.SEEK_SET)
@@ -384,57 +671,181 @@ class DatasetDiffractPlusV3( Dataset ):
 		#end of range
 	# end of def parse(self, ifstream )
 
+#
+# incremental reader for a raw file that is still being written
+# (FILE_STATUS "active") : each poll() maps the file again, decodes the ranges
+# completed since the previous poll and appends them to self.dataset
+#
+class RawFileFollower(object):
+	def __init__(self, fn):
+		self.fn = fn
+		self.dataset = DatasetDiffractPlusV3( use_mmap = True )
+		self.offset = DatasetDiffractPlusV3.FILE_HEADER_LENGTH  # start of the first range not consumed yet
+		self.count = 0                                           # number of ranges consumed
+
+	def finished(self):
+		'''True once the instrument closed the file and every range was read'''
+		ds = self.dataset
+		return ds._metadata.get('FILE_STATUS', 'active') != 'active' and self.count >= ds['RANGE_CNT']
+
+	def poll(self):
+		'''decode the ranges completed since the last call ; return them as a list
+
+		the file is mapped only for the duration of the call : the new ranges
+		get copies of their intensities, so that no map (and no file
+		descriptor) is kept alive from one poll to the next'''
+		ds = self.dataset
+		with open( self.fn, 'rb' ) as ifh:
+			size = os.fstat( ifh.fileno() ).st_size
+			if size < ds.FILE_HEADER_LENGTH :
+				return []
+			f, mapped = ds._map_file( ifh )
+		try:
+			if not ds.validate( f ):
+				raise Exception("The file format is not of 'diffract plus raw file version 3'.")
+			
+			# the file header is rewritten during the measurement (RANGE_CNT, status)
+			hdr = np.frombuffer( mapped, dtype = ds.file_header_dtype, count = 1 ).copy()[0]
+			for (k,t,s,l) in ds.file_header_desc_tbl :
+				ds[k] = hdr[k].item()
+			ds._set_file_status()
+			
+			offsets, self.offset = ds._range_offsets( mapped, max( ds['RANGE_CNT'] - self.count, 0 ), self.offset, size )
+			if 0 == len( offsets ):
+				return []
+			headers = ds._decode_range_headers( mapped, offsets )
+			new = [ ds._make_scan( mapped, headers, self.count + i, offsets[i], row = i ) for i in range( len(offsets) ) ]
+			for scn in new :
+				scn.ydata = np.array( scn.ydata )
+		finally:
+			f.close()
+		if ds.range_headers is None:
+			ds.range_headers = headers
+		else:
+			ds.range_headers = np.concatenate( ( ds.range_headers, headers ) )
+		ds.scans.extend( new )
+		self.count += len( new )
+		ds.determin_dataset_type()
+		return new
+
+def write_uxd( ds, ifn, ofh ):
+	''' write dataset ds, read from file ifn, as UXD text to the open handle ofh '''
+	ofh.write(';(content of file %s)\n' % ifn)  
+	ds.write(ofh, print_header = True )
+
 def convert_raw_to_uxd( ifn, ofn ):
 	print ifn, ofn
-	ds = DatasetDiffractPlusV3( open( ifn , 'rb') )
+	ds = DatasetDiffractPlusV3( open( ifn , 'rb'), use_mmap = True )
 	with open(ofn, 'wb') as ofh:
-		ofh.write(';(content of file %s)\n' % ifn)  
-		ofh.write(ds.pretty_format(print_header = True ))
+		write_uxd( ds, ifn, ofh )
+
+def ragged_to_2d(arrays):
+	''' arrays: {"omega", "tth", "data"} holding the points of all ranges
+	concatenated, and "offsets" where range i is [offsets[i], offsets[i+1]) (CSR style).
+	If all ranges have the same number of steps, return the usual 2D arrays
+	(one row per range, no "offsets" key) as views ; otherwise return arrays
+	unchanged. The ragged form can go through Ang2HKL/Ang2Q and gridding
+	as it is, those only need matching point arrays. '''
+	lengths = np.diff( arrays['offsets'] )
+	if len(lengths) and ( lengths != lengths[0] ).any():
+		return arrays
+	shape = ( len(lengths), lengths[0] if len(lengths) else 0 )
+	return dict( (k, arrays[k].reshape(shape)) for k in ("omega", "tth", "data") )
+
+def get_Bruker_raw(raw_file, uxd_file = None):
+	''' Read a RAW v3 file straight into the arrays returned by get_Bruker,
+	without going through the UXD text format.
+	uxd_file: if given, the UXD export is also written there '''
+	with open(raw_file, 'rb') as ifh:
+		ds = DatasetDiffractPlusV3( ifh, use_mmap = True )
+	if uxd_file:
+		with open(uxd_file, 'wb') as ofh:
+			write_uxd( ds, raw_file, ofh )
+	return ds.rsm_arrays()
+
+def merge_Bruker_raw(raw_files):
+	''' Read several RAW v3 files of one RSM (e.g. measured in several sessions)
+	into a single set of get_Bruker arrays, ranges sorted by omega.
+	The files are mapped and merged without copying ; the data are copied
+	only once, into the returned arrays '''
+	ds = None
+	for raw_file in raw_files:
+		with open(raw_file, 'rb') as ifh:
+			d = DatasetDiffractPlusV3( ifh, use_mmap = True )
+		ds = d if ds is None else ds.merge( d )
+	return ds.rsm_arrays( sort = True )
+
+def _uxd_ranges(fh, header):
+	''' yield (omega, data lines) for each range of the UXD file fh, holding
+	one range in memory at a time. Keys of interest found in the header
+	(RANGE_CNT) are stored in the dict header '''
+	theta = None
+	lines = None # None until the first range starts
+	for line in fh:
+		if not line.strip():
+			continue
+		elif line.startswith("_"):
+			if line.startswith("_OMEGA"):
+				theta = float(line.split("=")[1])
+			elif line.startswith("_RANGE_CNT"):
+				header['RANGE_CNT'] = int(line.split("=")[1])
+		elif line.startswith(";"):
+			if line.startswith("; ( Data for Range number") or line.startswith("; Data for range"):
+				if lines is not None:
+					yield theta, lines
+				lines = []
+		elif lines is not None:
+			lines.append(line)
+	if lines is not None:
+		yield theta, lines
+
+def _parse_uxd_block(lines):
+	''' parse the data lines of one range in bulk, return (tth, intensity) '''
+	ncol = len( lines[0].split() )
+	values = np.fromstring( "".join(lines), sep = " " )
+	if values.size != ncol * len(lines):
+		raise ValueError( "Malformed data line in UXD range: %r" % lines[0] )
+	values = values.reshape( len(lines), ncol )
+	return values[:,0], values[:,1]
 
 def get_Bruker(uxd_file):
 	#-- Read UXD file, output: theta file, 2Theta file and intensity file
+	# see ragged_to_2d for the layout when ranges have different numbers of steps
 	try:
 		data = open(uxd_file,'r')
 	except:
 		print "No such a Data file! Please check if you entered the correct path in ini file."
-	omega = []
-	tth_2d   = []
-	intensity_2d = []
-	tth = []            
-	intensity=[]
-	for lines in data.readlines():
-		if not lines.strip():
+		raise
+	header = {}
+	m = 0           # points read so far
+	offsets = [0]   # start of each range in the concatenated arrays
+	omega_r = []    # omega of each range
+	tth = intensity = None
+	for theta, lines in _uxd_ranges(data, header):
+		if not lines:
 			continue
-		elif lines.startswith("_"):
-			if lines.startswith("_OMEGA"):
-				line=lines.split("=")
-				theta=line[1]
-			else:
-				continue
-		elif lines.startswith(";"):
-			if lines.startswith("; ( Data for Range number") or lines.startswith("; Data for range"):
-				tth_2d.append(tth)
-				intensity_2d.append(intensity)
-				tth = []            
-				intensity=[]
-		else:
-			line=lines.split()
-			dTheta=line[0]
-			i=line[1]
-			omega.append(float(theta))
-			tth.append(float(dTheta))
-			intensity.append(float(i))
-	tth_2d.append(tth)
-	intensity_2d.append(intensity)
+		t, i = _parse_uxd_block(lines)
+		if tth is None:
+			# preallocate from the header, grow by doubling if it was wrong or missing
+			capacity = max( header.get('RANGE_CNT', 16), 1 ) * len(t)
+			tth = np.empty( capacity )
+			intensity = np.empty( capacity )
+		if m + len(t) > len(tth):
+			capacity = max( 2*len(tth), m + len(t) )
+			tth = np.resize( tth, capacity )
+			intensity = np.resize( intensity, capacity )
+		tth[m:m+len(t)] = t
+		intensity[m:m+len(t)] = i
+		m += len(t)
+		offsets.append( m )
+		omega_r.append( theta )
 	data.close()
 	
-	tth_2d = tth_2d[1:]
-	tth_2d = np.asarray(tth_2d)
-	intensity_2d = intensity_2d[1:]
-	intensity_2d = np.asarray(intensity_2d)
-	omega = np.asarray(omega)
-	omega = omega.reshape(intensity_2d.shape)
-	return {"omega":omega, "tth":tth_2d, "data":intensity_2d}
+	if tth is None:
+		tth = intensity = np.zeros( 0 )
+	offsets = np.asarray( offsets, dtype = np.int64 )
+	omega = np.repeat( np.asarray( omega_r, dtype = np.float64 ), np.diff(offsets) )
+	return ragged_to_2d( {"omega":omega, "tth":tth[:m], "data":intensity[:m], "offsets":offsets} )
 
 if '__main__' == __name__:
     import sys
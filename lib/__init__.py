@@ -2,10 +2,10 @@
 # -*- coding: utf-8 -*-
 
 # Automatically import "autonomous" modules
-__all__ = ['mca_spec', 'Bruker']
+__all__ = ['mca_spec', 'Bruker', 'formats', 'spec_catalogue', 'compressed']
 
-# # Modules depending on external (non-trivial) packages
-# __others__ = []
+# Modules depending on external (non-trivial) packages
+__others__ = ['raw2hdf']
 
 # Set to True if you want to import all previous modules directly
 importAll = True
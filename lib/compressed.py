@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Random access into gzip, bz2 and xz compressed SPEC/MCA files, without
+# decompressing them to disk: the decompressor state is saved at checkpoints
+# while the file is read, and later reads restart from the nearest checkpoint.
+# The checkpoints at the start of each stream (gzip member, bz2/xz stream) and the
+# uncompressed length are kept in a sidecar file (INDEX_SUFFIX) for later sessions:
+# files written as many members/streams (bgzip, pigz -i, pbzip2, cat a.gz b.gz) are
+# reached directly in a new process, while single-member gzip and single-stream
+# bz2/xz files still need a linear pass up to the data read, once per process.
+#
+# usage as a python module
+# from compressed import xopen
+# f = xopen('beamtime.spec.gz')  # plain files are opened with open()
+# f.seek(123456789); f.readline()
+
+import os
+import json
+import zlib
+import bz2
+try:
+	import lzma
+except ImportError:
+	try:
+		from backports import lzma
+	except ImportError:
+		lzma = None # xz files cannot be read
+
+MAGIC = [("gzip", "\x1f\x8b"), ("bz2", "BZh"), ("xz", "\xfd7zXZ\x00")]
+
+# uncompressed bytes between two gzip checkpoints: a seek decompresses at most this much
+CHECKPOINT_SPACING = 1 << 20
+# compressed bytes read at a time
+READ_SIZE = 1 << 16
+# sidecar file holding the stream checkpoints and the uncompressed length, next to the compressed file
+INDEX_SUFFIX = ".zidx"
+INDEX_VERSION = 1
+
+def compression(fn):
+	""" 'gzip', 'bz2', 'xz' or None, from the first bytes of file fn """
+	with open(fn, "rb") as f:
+		head = f.read(6)
+	for name, magic in MAGIC:
+		if head.startswith(magic):
+			return name
+	return None
+
+class CompressedIndex(object):
+	""" Checkpoints of a compressed file, sorted by uncompressed offset """
+	def __init__(self, stamp=None):
+		self.checkpoints = [(0, 0, None)] # decompressor None: new stream starting at that compressed offset
+		self.frontier = 0 # uncompressed bytes decompressed so far, checkpoints cover [0, frontier)
+		self.length = None # uncompressed size, known once the end was reached
+		self.tail = (0, "") # last decompressed chunk of the file, where searches for the last line end
+		self.stamp = stamp # (size, mtime) of the file, None: the index is not saved
+		self.saved = None # (number of stream checkpoints, length) in the sidecar file
+
+	def streams(self):
+		""" (uncompressed offset, compressed offset) of the start of each stream """
+		return [(u, c) for u, c, d in self.checkpoints if d is None]
+
+def load_index(fn, stamp):
+	""" CompressedIndex of fn read from its sidecar file, or a new one if it is missing or out of date.
+	Only the stream checkpoints are saved: no gzip checkpoint is recorded inside the streams already known
+	"""
+	index = CompressedIndex(stamp)
+	try:
+		with open(fn + INDEX_SUFFIX) as f:
+			d = json.load(f)
+	except (IOError, ValueError):
+		return index
+	if d.get("version") != INDEX_VERSION or [d.get("size"), d.get("mtime")] != list(stamp):
+		return index
+	index.checkpoints = [(u, c, None) for u, c in d["streams"]]
+	index.frontier = index.checkpoints[-1][0]
+	index.length = d["length"]
+	index.saved = (len(index.checkpoints), index.length)
+	return index
+
+def save_index(fn, index):
+	""" Write the sidecar file of fn if index found new streams or the length - silently skipped if the folder is read-only """
+	streams = index.streams()
+	if index.stamp is None or index.saved == (len(streams), index.length):
+		return
+	d = {"version": INDEX_VERSION, "size": index.stamp[0], "mtime": index.stamp[1], "length": index.length, "streams": streams}
+	try:
+		with open(fn + INDEX_SUFFIX + ".part", "w") as f:
+			json.dump(d, f)
+		os.rename(fn + INDEX_SUFFIX + ".part", fn + INDEX_SUFFIX)
+	except (IOError, OSError):
+		return
+	index.saved = (len(streams), index.length)
+
+class CompressedFile(object):
+	""" Read-only, seekable file object on a gzip, bz2 or xz file.
+	Checkpoints (uncompressed offset, compressed offset, decompressor state) are recorded as the
+	file is decompressed: every CHECKPOINT_SPACING bytes for gzip (zlib decompressors can be copied),
+	and at the start of each stream for bz2 and xz, e.g. files written by pbzip2 or cat a.bz2 b.bz2.
+	Seeking backwards, or far forward, restarts from the nearest checkpoint before the target.
+	Also provides find, rfind, len and slicing (non-negative indices) like an mmap, see mca_spec.SpecFile.
+	index: CompressedIndex of fn, shared between the objects opened on the same file
+	"""
+	def __init__(self, fn, kind=None, index=None):
+		self.name = fn
+		self.kind = kind or compression(fn)
+		if self.kind == "xz" and lzma is None:
+			raise IOError("xz files need the lzma module (backports.lzma on python 2): %s"%fn)
+		if self.kind not in ("gzip", "bz2", "xz"):
+			raise IOError("Not a gzip, bz2 or xz file: %s"%fn)
+		self.index = index or CompressedIndex()
+		self._f = open(fn, "rb")
+		self._pos = 0
+		self._chunk = (0, "")
+		self._restart(self.index.checkpoints[0])
+
+	def _new_decompressor(self):
+		if self.kind == "gzip":
+			return zlib.decompressobj(16 + zlib.MAX_WBITS)
+		elif self.kind == "bz2":
+			return bz2.BZ2Decompressor()
+		return lzma.LZMADecompressor()
+
+	def _restart(self, checkpoint):
+		self._upos, self._cpos, d = checkpoint
+		self._d = d.copy() if d is not None else self._new_decompressor()
+		self._fresh = False # True while the current stream was started from data following a previous one
+
+	def _feed(self, data):
+		""" decompress data, starting new streams (gzip members) when one ends """
+		out = []
+		while data and self._d is not None:
+			try:
+				out.append(self._d.decompress(data))
+				unused = self._d.unused_data
+			except EOFError: # bz2, xz: the stream ended exactly with the previous data
+				unused = data
+			except Exception:
+				if not self._fresh:
+					raise
+				# not a new stream but padding or garbage after the last one: ignore the rest of the file
+				self._d = None
+				if self.index.checkpoints[-1][1] == self._stream_cpos:
+					self.index.checkpoints.pop()
+				break
+			self._fresh = False
+			if not unused:
+				break
+			upos = self._upos + sum(len(o) for o in out)
+			self._stream_cpos = self._cpos - len(unused)
+			if upos >= self.index.frontier and upos > self.index.checkpoints[-1][0]:
+				self.index.checkpoints.append((upos, self._stream_cpos, None))
+			self._d = self._new_decompressor()
+			self._fresh = True
+			data = unused
+		return "".join(out)
+
+	def _next_chunk(self):
+		""" decompress the next READ_SIZE compressed bytes: (uncompressed offset, data), data is None at the end """
+		ck = self.index.checkpoints
+		if self.kind == "gzip" and self._d is not None and self._upos >= self.index.frontier and self._upos - ck[-1][0] >= CHECKPOINT_SPACING:
+			ck.append((self._upos, self._cpos, self._d.copy()))
+		self._f.seek(self._cpos)
+		data = self._f.read(READ_SIZE)
+		start = self._upos
+		if not data:
+			self.index.length = start
+			return start, None
+		self._cpos += len(data)
+		out = self._feed(data)
+		self._upos += len(out)
+		self.index.frontier = max(self.index.frontier, self._upos)
+		return start, out
+
+	def _chunk_at(self, pos):
+		""" decompressed chunk (start, data) holding offset pos, data is '' after the end """
+		for start, data in (self._chunk, self.index.tail):
+			if start <= pos < start + len(data):
+				return start, data
+		if self.index.length is not None and pos >= self.index.length:
+			return pos, ""
+		if not (self._upos <= pos < self._upos + CHECKPOINT_SPACING):
+			best = self.index.checkpoints[0]
+			for c in self.index.checkpoints:
+				if c[0] > pos:
+					break
+				best = c
+			if not (self._upos <= pos and best[0] <= self._upos):
+				self._restart(best)
+		while True:
+			start, data = self._next_chunk()
+			if data is None:
+				if self._chunk[1]:
+					self.index.tail = self._chunk
+				return pos, ""
+			if data:
+				self._chunk = (start, data)
+			if pos < start + len(data):
+				break
+		return start, data
+
+	# file object
+	def read(self, n=-1):
+		out = []
+		while n < 0 or n > 0:
+			start, data = self._chunk_at(self._pos)
+			if not data:
+				break
+			i = self._pos - start
+			piece = data[i:] if n < 0 else data[i:i + n]
+			out.append(piece)
+			self._pos += len(piece)
+			if n > 0:
+				n -= len(piece)
+		return "".join(out)
+
+	def readline(self):
+		out = []
+		while True:
+			start, data = self._chunk_at(self._pos)
+			if not data:
+				break
+			i = self._pos - start
+			e = data.find("\n", i)
+			piece = data[i:] if e < 0 else data[i:e + 1]
+			out.append(piece)
+			self._pos += len(piece)
+			if e >= 0:
+				break
+		return "".join(out)
+
+	def readlines(self):
+		return list(self)
+
+	def __iter__(self):
+		return iter(self.readline, "")
+
+	def seek(self, offset, whence=0):
+		if whence == 1:
+			offset += self._pos
+		elif whence == 2:
+			offset += len(self)
+		self._pos = max(0, offset)
+
+	def tell(self):
+		return self._pos
+
+	def close(self):
+		save_index(self.name, self.index)
+		self._f.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	# mmap-like access
+	def __len__(self):
+		while self.index.length is None:
+			self._chunk_at(max(self.index.frontier, self._upos))
+		return self.index.length
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			start = i.start or 0
+			pos = self._pos
+			self._pos = start
+			data = self.read(-1 if i.stop is None else max(0, i.stop - start))
+			self._pos = pos
+			return data
+		start, data = self._chunk_at(i)
+		if not data:
+			raise IndexError("CompressedFile index out of range")
+		return data[i - start]
+
+	def find(self, sub, start=0, end=None):
+		pos, carry = start, ""
+		while end is None or pos < end:
+			cstart, data = self._chunk_at(pos)
+			if not data:
+				break
+			piece = data[pos - cstart:] if end is None else data[pos - cstart:end - cstart]
+			text = carry + piece
+			i = text.find(sub)
+			if i >= 0:
+				return pos - len(carry) + i
+			carry = text[len(text) - len(sub) + 1:] if len(sub) > 1 else ""
+			pos += len(piece)
+		return -1
+
+	def rfind(self, sub, start=0, end=None):
+		if end is None:
+			end = len(self)
+		hi = end
+		while hi > start:
+			lo = max(start, hi - READ_SIZE)
+			i = self[lo:min(end, hi + len(sub) - 1)].rfind(sub)
+			if i >= 0:
+				return lo + i
+			hi = lo
+		return -1
+
+# checkpoints of the files already opened by this process: absolute file name -> (size, mtime, CompressedIndex)
+_indexes = {}
+
+def open_compressed(fn):
+	""" CompressedFile on fn, reusing the checkpoints recorded by previous calls, or saved by previous sessions,
+	if fn did not change. They are saved when the file is closed """
+	key = os.path.abspath(fn)
+	st = os.stat(fn)
+	size, mtime, index = _indexes.get(key, (None, None, None))
+	if index is None or (size, mtime) != (st.st_size, st.st_mtime):
+		index = load_index(fn, (st.st_size, st.st_mtime))
+		_indexes[key] = (st.st_size, st.st_mtime, index)
+	return CompressedFile(fn, index=index)
+
+def xopen(fn):
+	""" Open fn for reading, decompressing it on the fly if it is a gzip, bz2 or xz file """
+	if compression(fn) is None:
+		return open(fn, "r")
+	return open_compressed(fn)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Identification of the lab/synchrotron data files handled by the package
+# (SPEC, MCA, Bruker RAW, UXD, XRDML, converted HDF5) from their first bytes,
+# and registry of the function reading each format
+#
+# usage as a python module
+# from formats import identify, classify_folder, get_reader
+# identify('map.raw')               -> 'bruker_raw'
+# classify_folder('data/')          -> {'bruker_raw': [...], 'spec': [...], ...}
+# get_reader('bruker_raw')('map.raw')
+
+import os
+import collections
+
+# number of bytes read to identify a file
+HEAD_SIZE = 4096
+
+HDF5_SIGNATURE = "\x89HDF\r\n\x1a\n"
+
+def _is_bruker_raw(head):
+	return head.startswith("RAW1.01")
+
+def _is_hdf5(head):
+	return head.startswith(HDF5_SIGNATURE)
+
+def _is_xrdml(head):
+	return head.lstrip("\xef\xbb\xbf \t\r\n").startswith("<?xml") and "xrdMeasurement" in head
+
+def _is_uxd(head):
+	# Bruker text export: ';' comment and '_KEY = value' lines before the data
+	first = head.lstrip()
+	return first[:1] in (";", "_") and "\n_" in head
+
+def _is_mca(head):
+	# spec format holding only PSD spectra (@A lines), as read by ReadMCA / ReadMCA2D_complete.
+	# SPEC files with inline spectra (skipped by ReadSpec) have a '#L' line before their first '@A' line
+	if not head.startswith("#"):
+		return False
+	a = head.find("\n@A ")
+	if a < 0 and "#@MCA" not in head and "#@CHANN" not in head:
+		return False
+	l = head.find("\n#L")
+	return l < 0 or 0 <= a < l
+
+def _is_spec(head):
+	return head.startswith("#") and ("\n#S " in head or head.startswith("#F ") or head.startswith("#S "))
+
+# name -> (test on the first HEAD_SIZE bytes, usual extensions, "module.function" reading the format)
+# the order matters: the first matching test wins (MCA files are also SPEC files)
+READERS = collections.OrderedDict()
+
+def register(name, sniff, extensions = (), reader = None):
+	""" Add (or replace) a format: sniff(head) returns True for files of this format,
+	reader is the dotted name of the function loading it, imported when needed """
+	READERS[name] = (sniff, tuple(extensions), reader)
+
+register("bruker_raw", _is_bruker_raw, (".raw",), "Bruker.get_Bruker_raw")
+register("hdf5",       _is_hdf5,       (".h5", ".hdf5"), "h5py.File")
+register("xrdml",      _is_xrdml,      (".xrdml",), "xrayutilities.io.XRDMLFile")
+register("mca",        _is_mca,        (".mca",), "mca_spec.ReadMCA2D_complete")
+register("spec",       _is_spec,       (".spec", ".dat"), "mca_spec.ReadSpec")
+register("uxd",        _is_uxd,        (".uxd",), "Bruker.get_Bruker")
+
+def identify(fn, head = None):
+	""" Name of the format of file fn, or None if unknown. Only the first HEAD_SIZE bytes are read """
+	if head is None:
+		try:
+			with open(fn, "rb") as f:
+				head = f.read(HEAD_SIZE)
+		except IOError:
+			return None
+	for name, (sniff, extensions, reader) in READERS.items():
+		if sniff(head):
+			return name
+	return None
+
+def classify_folder(folder, formats = None):
+	""" {format name: sorted list of file names} for the files of folder,
+	restricted to the given format names if formats is not None """
+	found = collections.defaultdict(list)
+	for name in sorted(os.listdir(folder)):
+		path = os.path.join(folder, name)
+		if not os.path.isfile(path):
+			continue
+		fmt = identify(path)
+		if fmt is not None and (formats is None or fmt in formats):
+			found[fmt].append(name)
+	return dict(found)
+
+def get_reader(name):
+	""" Function reading files of format name (see READERS) """
+	module, function = READERS[name][2].rsplit(".", 1)
+	package = __name__.rpartition(".")[0]
+	try:
+		# modules of this package first, e.g. Bruker or mca_spec
+		mod = __import__(package + "." + module if package else module, fromlist = [function])
+	except ImportError:
+		mod = __import__(module, fromlist = [function])
+	return getattr(mod, function)
@@ -11,6 +11,14 @@ import numpy as np
 import copy
 import math
 import time
+import os
+import re
+import mmap
+import multiprocessing
+import json
+import hashlib
+import cPickle
+from compressed import compression,open_compressed,xopen
 
 def rebin3(a, (m, n, o)):
    if (m,n,o)==(1,1,1): return a
@@ -34,6 +42,25 @@ def list2float(l):
       l[i]=float(l[i])
    return l
 
+def _readonly(a):
+   a.flags.writeable=False
+   return a
+
+class _ReadOnlyDict(dict):
+   """ dictionnary whose items cannot be changed after construction """
+   def _refuse(self,*args,**kwargs):
+      raise TypeError("read-only dictionnary")
+   __setitem__=__delitem__=clear=pop=popitem=setdefault=update=_refuse
+   def __reduce__(self):
+      return (_ReadOnlyDict,(dict(self),))
+
+def _frozen(v):
+   """ read-only copy of a header value: arrays, lists and dictionnaries, recursively """
+   if isinstance(v,np.ndarray):return _readonly(np.array(v))
+   if isinstance(v,dict):return _ReadOnlyDict((k,_frozen(x)) for k,x in v.items())
+   if isinstance(v,list) or isinstance(v,tuple):return tuple(_frozen(x) for x in v)
+   return v
+
 def vcross(v,w):
    return reshape(cross(v.flat,w.flat),v.shape)
 
@@ -84,43 +111,65 @@ class SpecSetup:
 gSpecSetup=SpecSetup()
    
 
-class SpecGeometry:
+_gonio_warning=[True]# print the gonio/gmci warning of Angles2HKL only once
+
+class SpecGeometry(object):
    """ Spec parameters (lattice parameters, orientation reflections and matrix as deduced from
    a Spec header, and current 'P' values for motors.
    
+   All parameters are set by the constructor and cannot be changed afterwards (arrays are read-only,
+   headers and G are read-only copies), so that one geometry can be used by several threads,
+   e.g. to convert many scans in a thread pool.
+   
+   psd0: position of the direct beam on the psd
+   psdPixelSizeOverDistance: PSD pixel size, divided by the distance between sample and the PSD
+   psdor: orientation of psd: "out" horizontal (+k), "in" horizontal (-k), "up" vertical (+i), "down" vertical (-i)
+   None gives the default value.
    """
-   G={}# raw Geometrical parameters parameters (G0= mode, sector, azH,azK,azL, zoneH0,zoneK0,zoneL0,
-       #                                        G1= lattice parameters (direct and reciprocal space), 1st reflection angles, 2nd reflection, reflection HKL's
-       #                                        G3=  UB*2pi matrix , G4= H K L and ??????
-   P=[]# raw 'P' parameters - motor values, depends on beamlines !
-   q0=zeros((3,1),float32) # current Q vector, in HKL coordinates
-   psd0=257.6            # position of the direct beam on the psd
-   psdPixelSizeOverDistance=0.000115    # PSD pixel size, divided by the distance between sample and the PSD
-   psdor="out" #orientation of psd: "out" horizontal (+k), "in" horizontal (-k), "up" vertical (+i), "down" vertical (-i)
-   warning=True
-   def __init__(self,headers):
-      self.headers=headers
+   def __init__(self,headers,psd0=None,psdPixelSizeOverDistance=None,psdor=None):
+      self.headers=_frozen(dict(headers))
+      self.psd0=257.6 if psd0 is None else psd0
+      self.psdPixelSizeOverDistance=0.000115 if psdPixelSizeOverDistance is None else psdPixelSizeOverDistance
+      self.psdor="out" if psdor is None else psdor
+      G={}# raw Geometrical parameters parameters (G0= mode, sector, azH,azK,azL, zoneH0,zoneK0,zoneL0,
+               #                                        G1= lattice parameters (direct and reciprocal space), 1st reflection angles, 2nd reflection, reflection HKL's
+               #                                        G3=  UB*2pi matrix , G4= H K L and ??????
+      P=zeros(0,float)# raw 'P' parameters - motor values, depends on beamlines !
+      q0=zeros((3,1),float32) # current Q vector, in HKL coordinates
       for k in headers.keys():
          if k[0]=='G':
-            self.G[k]=list2float(headers[k])
+            G[k]=_readonly(np.array(headers[k],float))
          if k[0]=='P':
-            self.P=list2float(headers[k])
+            P=np.array(headers[k],float)
          if k[0]=='Q':
-            self.q0[0][0],self.q0[1][0],self.q0[2][0]=float(headers[k][0]),float(headers[k][1]),float(headers[k][2])
-      self.lattice  =[self.G["G1"][0],self.G["G1"][1],self.G["G1"][2],self.G["G1"][3]*pi/180,self.G["G1"][4 ]*pi/180,self.G["G1"][5 ]*pi/180]
-      self.lattice_r=[self.G["G1"][6],self.G["G1"][7],self.G["G1"][8],self.G["G1"][9]*pi/180,self.G["G1"][10]*pi/180,self.G["G1"][11]*pi/180]
+            q0[0][0],q0[1][0],q0[2][0]=float(headers[k][0]),float(headers[k][1]),float(headers[k][2])
+      self.G=_ReadOnlyDict(G)
+      self.P=_readonly(P)
+      self.q0=_readonly(q0)
+      self.lattice  =(self.G["G1"][0],self.G["G1"][1],self.G["G1"][2],self.G["G1"][3]*pi/180,self.G["G1"][4 ]*pi/180,self.G["G1"][5 ]*pi/180)
+      self.lattice_r=(self.G["G1"][6],self.G["G1"][7],self.G["G1"][8],self.G["G1"][9]*pi/180,self.G["G1"][10]*pi/180,self.G["G1"][11]*pi/180)
       # Spec orientation matrix
-      self.ub=array([[self.G["G3"][0],self.G["G3"][1],self.G["G3"][2]],[self.G["G3"][3],self.G["G3"][4],self.G["G3"][5]],[self.G["G3"][6],self.G["G3"][7],self.G["G3"][8]]])/(2*pi)
+      self.ub=_readonly(array([[self.G["G3"][0],self.G["G3"][1],self.G["G3"][2]],[self.G["G3"][3],self.G["G3"][4],self.G["G3"][5]],[self.G["G3"][6],self.G["G3"][7],self.G["G3"][8]]])/(2*pi))
       self.wavelength=self.G["G4"][3]
       #Current motor positions, as a dictionnary
-      self.angles0={}
+      angles0={}
       for i in xrange(len(self.P)):# :TODO: Some motor names may include spaces, and break conversion
          name=headers["O"][i]
          if name=="phi":name="Phi"
          if name=="chi":name="Chi"
          if name=="mu":name="Mu"
-         if not self.angles0.has_key(name):# Kludge - e.g. if one motor is "Theta" and another is "Theta def."...
-            self.angles0[name]=self.P[i]*pi/180
+         if not angles0.has_key(name):# Kludge - e.g. if one motor is "Theta" and another is "Theta def."...
+            angles0[name]=self.P[i]*pi/180
+      self._angles0=angles0
+      self._frozen=True
+   def __setattr__(self,name,value):
+      if self.__dict__.get("_frozen",False):
+         raise AttributeError("SpecGeometry parameters are set by the constructor: %s"%name)
+      object.__setattr__(self,name,value)
+   @property
+   def angles0(self):
+      """ Motor positions before the scan, in radians: a new dictionnary at each call """
+      return dict(self._angles0)
    def Z(self,angles):
       """ Get the orientation matrix due to the sample motor angles
       """
@@ -157,7 +206,7 @@ class SpecGeometry:
       #elif self.headers["geom"]=="dafs":
       #else:
       #   except("!! Unknown spec geometry:",self.headers.geom)
-      if psd !=None:# this is for an *horizontal* PSD
+      if psd is not None:# this is for an *horizontal* PSD
          if isscalar(psd):
             if self.psdor=="out":
                ql+=array([[0.0],[0.0],[self.psdPixelSizeOverDistance*(psd-self.psd0)]])
@@ -197,9 +246,9 @@ class SpecGeometry:
       ql=self.QL(angles,psd=psd)
       h=dot(im,ql)
       if self.headers["geom"]=="gonio" or self.headers["geom"]=="gmci":
-         if self.warning:
+         if _gonio_warning[0]:
             print "WARNING gn,onio/gmci: rotating h/k"
-            self.warning=False
+            _gonio_warning[0]=False
          # WHY ??? Not using Busing & Levy axis convention ?
          horig=copy.deepcopy(h)
          h[0,:]=-horig[1,:]
@@ -222,76 +271,446 @@ class SpecGeometry:
       return h
 
 
-def ReadSpec(fname,scan):
-   f=open(fname,'r')
+################################# SPEC scan index ###############################
+class SpecFile:
+   """ Read-only memory map of a spec file. Markers are found with byte searches, and scan data
+   blocks are handed out as buffers on the map: memory use does not depend on the size of the file.
+   gzip, bz2 and xz files are read through a compressed.CompressedFile instead of a map.
+   """
+   def __init__(self,fname):
+      self.fname=fname
+      self.compressed=compression(fname) is not None
+      if self.compressed:
+         self.map=open_compressed(fname)
+         return
+      f=open(fname,'rb')
+      if os.fstat(f.fileno()).st_size>0:
+         self.map=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+      else:# empty files cannot be mapped
+         self.map=""
+      f.close()
+   def __len__(self):
+      return len(self.map)
+   def close(self):
+      if not isinstance(self.map,str):self.map.close()
+   def find(self,sub,start=0,end=None):
+      if end is None:end=len(self.map)
+      return self.map.find(sub,start,end)
+   def line(self,pos):
+      """ line starting at offset pos, and offset of the next line """
+      end=self.map.find("\n",pos)+1
+      if end==0:end=len(self.map)
+      return self.map[pos:end],end
+   def block(self,start,end):
+      if self.compressed:return self.map[start:end]
+      return buffer(self.map,start,end-start)
+
+SPEC_INDEX_SUFFIX=".idx" # sidecar file holding the index, next to the spec file
+SPEC_INDEX_VERSION=3
+SPEC_INDEX_CHECK=4096    # bytes at the beginning and at the end of the indexed part, used to check that the file only grew
+_spec_indexes={}         # absolute file name -> SpecIndex, indexes already loaded by this process
+
+class SpecIndex:
+   """ Byte offsets of the scans of a spec file, built in a single pass over the file.
+   
+   scans[number]=[S,L,data,O,C,end,complete]: offsets of the '#S' line, of the '#L' line, of the first
+   line after '#L', of the '#O0' line giving the motor names used by the scan, of the first '#C' line
+   of the file (geometry), and of the end of the scan (next '#S' line or end of file). Missing lines
+   have offset -1. complete is 0 for a scan still being recorded: neither followed by another scan
+   nor closed by an empty line. When a scan number is used twice, only the first scan is indexed,
+   as ReadSpec always returned the first one.
+   The index is saved in fname+SPEC_INDEX_SUFFIX. When the spec file only grew (beamline files
+   are append-only), update() re-reads it from the last '#S' line instead of from the beginning.
+   Offsets of compressed files are offsets in the decompressed data.
+   """
+   def __init__(self,fname):
+      self.fname=fname
+      self.size=None# bytes indexed
+      self.fsize=None# size and modification time of the file when indexed
+      self.mtime=None
+      self.check=None
+      self.scans={}
+      self.order=[]# scan numbers, in the order of the file
+      self.tail=[0,-1,-1]# offset of the last '#S' line, and O, C offsets in use there
+      self.headers={}# (O,C) -> (geometry, motor names), see _SpecFileHeaders
+   def valid(self,st=None):
+      if st is None:st=os.stat(self.fname)
+      return self.fsize==st.st_size and self.mtime==st.st_mtime
+   def _check(self,m,size):
+      return hashlib.md5(m.map[:min(size,SPEC_INDEX_CHECK)]+m.map[max(0,size-SPEC_INDEX_CHECK):size]).hexdigest()
+   def build(self):
+      self.size,self.fsize,self.mtime=None,None,None
+      self.update()
+   def update(self,st=None):
+      """ Bring the index up to date with the file """
+      if st is None:st=os.stat(self.fname)
+      m=SpecFile(self.fname)
+      if self.size is not None and not m.compressed and st.st_size>=self.size and self._check(m,self.size)==self.check:
+         pos,O,C=self.tail
+         if self.order and self.scans[self.order[-1]][0]==pos:# last scan may have changed
+            del self.scans[self.order.pop()]
+      else:
+         self.scans={}
+         self.order=[]
+         self.headers={}
+         pos,O,C=0,-1,-1
+      size=m.map.rfind("\n")+1# a last line without end of line is being written, read it at the next update
+      cur=None
+      # only header lines (starting with '#') are looked at, data lines are skipped with byte searches
+      while pos<size:
+         if m.map[pos]!="#":
+            pos=m.find("\n#",pos,size)+1
+            if pos==0:break;
+            continue
+         l,end=m.line(pos)
+         if l[0:2]=="#S":
+            if cur is not None:cur[5],cur[6]=pos,1
+            self.tail=[pos,O,C]
+            n=int(l.split()[1])
+            if self.scans.has_key(n):
+               cur=None
+            else:
+               cur=[pos,-1,-1,O,C,-1,0]
+               self.scans[n]=cur
+               self.order.append(n)
+         elif l[0:2]=="#L":
+            if cur is not None and cur[1]<0:
+               cur[1]=pos
+               cur[2]=end
+         elif l[0:3]=="#O0":
+            O=pos
+         elif C<0 and l[0:2]=="#C":
+            C=pos
+         pos=end
+      if cur is not None:
+         cur[5]=size
+         if cur[2]>=0 and _spec_empty_line.search(m.block(cur[2],size)):# data closed by an empty line
+            cur[6]=1
+      self.size,self.fsize,self.mtime=size,st.st_size,st.st_mtime
+      self.check=self._check(m,size)
+      m.close()
+   def load(self):
+      """ Read the sidecar file, whether it is up to date or not. Return False if it is missing """
+      try:
+         f=open(self.fname+SPEC_INDEX_SUFFIX,'r')
+         d=json.load(f)
+         f.close()
+      except (IOError,ValueError):
+         return False
+      if d.get("version")!=SPEC_INDEX_VERSION:
+         return False
+      self.scans={}
+      self.order=[]
+      for e in d["scans"]:
+         self.scans[e[0]]=e[1:]
+         self.order.append(e[0])
+      self.size,self.fsize,self.mtime,self.check,self.tail=d["size"],d["fsize"],d["mtime"],d["check"],d["tail"]
+      return True
+   def save(self):
+      """ Write the sidecar file - silently skipped if the folder is read-only """
+      d={"version":SPEC_INDEX_VERSION,"size":self.size,"fsize":self.fsize,"mtime":self.mtime,"check":self.check,"tail":self.tail,
+         "scans":[[n]+self.scans[n] for n in self.order]}
+      fn=self.fname+SPEC_INDEX_SUFFIX
+      try:
+         f=open(fn+".part",'w')
+         json.dump(d,f)
+         f.close()
+         os.rename(fn+".part",fn)
+      except (IOError,OSError):
+         pass
+   def get(self,scan):
+      if not self.scans.has_key(scan):
+         raise KeyError("Scan #S %i not found in %s"%(scan,self.fname))
+      return self.scans[scan]
+   def is_complete(self,scan):
+      return self.get(scan)[6]==1
+
+def GetSpecIndex(fname):
+   """ SpecIndex of a spec file, up to date: from memory or from its sidecar file,
+   extended if the file grew since, rebuilt if it was modified otherwise
+   """
+   key=os.path.abspath(fname)
+   st=os.stat(fname)
+   idx=_spec_indexes.get(key)
+   if idx is None:
+      idx=SpecIndex(fname)
+      idx.load()
+      _spec_indexes[key]=idx
+   if not idx.valid(st):
+      idx.update(st)
+      idx.save()
+   return idx
+
+_spec_empty_line=re.compile(r"^\r?\n",re.M)
+_spec_not_data=re.compile(r"^[#@]",re.M)
+_spec_comment_lines=re.compile(r"^#.*\n?",re.M)
+_spec_mca_lines=re.compile(r"^@(?:.*\\\r?\n)*.*\n?",re.M)# '@A' line and its continuation lines, ending with a backslash
+
+def ParseSpecBlock(block,ncol,usecols=None):
+   """ Parse the data lines of a scan (the text following the '#L' line) in one go.
+   Reading stops at the first empty line, '#' comment lines and '@A' MCA spectra are skipped.
+   block: string, or buffer e.g. from SpecFile.block
+   usecols: indices of the columns to keep (default: all)
+   return: float32 array of shape (ncol or len(usecols), number of points), one row per column
+   """
+   e=_spec_empty_line.search(block)
+   if e:block=buffer(block,0,e.start())
+   if _spec_not_data.search(block):
+      block=_spec_mca_lines.sub("",_spec_comment_lines.sub("",block))
+   nb=np.count_nonzero(np.frombuffer(block,uint8)==10)+(len(block)>0 and block[-1]!="\n")
+   v=np.fromstring(block,dtype=float64,sep=" ")
+   if len(v)==nb*ncol:
+      v=v.reshape((nb,ncol))
+   else:# lines with missing or extra values: e.g. last line of a scan being recorded
+      v=[np.fromstring(l,dtype=float64,sep=" ")[:ncol] for l in str(block).splitlines()]
+      v=array([l for l in v if len(l)==ncol],float64).reshape((-1,ncol))
+   v=v.T
+   if usecols is not None:v=v[list(usecols)]
+   return np.ascontiguousarray(v,dtype=float32)
+
+def ReadSpec(fname,scan,columns=None):
+   """ Read scan number scan of a spec file.
+   columns: names of the counters to return (default: all). Names missing from the scan are ignored.
+   return: headers,d - d maps each counter name to a float32 array, d is empty for a scan without '#L' line
+   """
    s="#S %i"%scan
    print s
-   title=0
-   headers={}
-   headers["geom"]=""
-   while 1:
-      title=f.readline()
-      if s == title[0:len(s)]:
-         break;
-      if "#O0"==title[0:3]:#Motor names, in the order reported in 
+   idx=GetSpecIndex(fname)
+   m=SpecFile(fname)
+   headers,d=_ReadSpecScan(m,idx,idx.get(scan),columns)
+   m.close()
+   return headers,d
+
+def ReadSpecMany(fname,scans,columns=None,cache=True):
+   """ Read several scans of a spec file, with a single pass over the file:
+   the scans are read in the order of the file, whatever the order of scans.
+   cache: False to bypass the cache of parsed scans, e.g. for scans read only once
+   return: list of (headers,d) as returned by ReadSpec, in the order of scans
+   """
+   idx=GetSpecIndex(fname)
+   entries=[idx.get(scan) for scan in scans]
+   res=[None]*len(scans)
+   m=SpecFile(fname)
+   for i in sorted(xrange(len(scans)),key=lambda i:entries[i][0]):
+      print "#S %i"%scans[i]
+      res[i]=_ReadSpecScan(m,idx,entries[i],columns,cache)
+   m.close()
+   return res
+
+def _ReadSpecChunk(job):
+   """ pool worker of ReadSpecParallel: [(headers,d)] of consecutive scans """
+   fname,entries,columns,cache=job
+   idx=SpecIndex(fname)# only used for its cache of file headers
+   m=SpecFile(fname)
+   res=[_ReadSpecScan(m,idx,entry,columns,cache) for entry in entries]
+   m.close()
+   return res
+
+def ReadSpecParallel(fname,scans=None,columns=None,processes=None,chunks_per_process=4,cache=True):
+   """ Parse many scans of a spec file (default: all of them) in a pool of worker processes.
+   The scans are split at scan boundaries into runs of consecutive scans, each worker maps the
+   file and parses its runs, and the arrays are sent back pickled.
+   processes: number of worker processes (default: number of CPUs)
+   cache: False to bypass the cache of parsed scans, e.g. for scans read only once
+   return: list of (headers,d) as returned by ReadSpec, in the order of scans
+   """
+   idx=GetSpecIndex(fname)
+   if scans is None:
+      scans=idx.order
+   entries=[idx.get(scan) for scan in scans]
+   order=sorted(xrange(len(scans)),key=lambda i:entries[i][0])
+   if processes is None:
+      processes=multiprocessing.cpu_count()
+   n=max(1,int(ceil(len(order)/float(processes*chunks_per_process))))
+   runs=[order[i:i+n] for i in xrange(0,len(order),n)]
+   jobs=[(fname,[entries[i] for i in run],columns,cache) for run in runs]
+   res=[None]*len(scans)
+   if processes==1 or len(jobs)<2:
+      done=[_ReadSpecChunk(job) for job in jobs]
+   else:
+      pool=multiprocessing.Pool(processes)
+      try:
+         done=pool.map(_ReadSpecChunk,jobs,1)
+      finally:
+         pool.close()
+         pool.join()
+   for run,scans_read in zip(runs,done):
+      for i,s in zip(run,scans_read):
+         res[i]=s
+   return res
+
+def _SpecFileHeaders(m,idx,O,C):
+   """ geometry and motor names of the file header at offsets O, C - parsed once, then cached in idx """
+   key=(O,C)
+   if not idx.headers.has_key(key):
+      geom,names="",None
+      if C>=0:# first comment gives used geometry / spec session name (gnio, psic, dafs)
+         geom=m.line(C)[0].split()[1]
+      if O>=0:#Motor names, in the order reported in #P
          #:TODO: some motors have spaces in their names !!
-         headers["O"]=title.split()[1:]
-      else:
-         if "#O"==title[0:2]:#Motor names, continued
-            headers["O"]+=title.split()[1:]
-      if headers["geom"]=="" and "#C"==title[0:2]:# first comment gives used geometry / spec session name (gnio, psic, dafs)
-         headers["geom"]=title.split()[1]
-      if len(title)==0:
-         break;
+         title,pos=m.line(O)
+         names=title.split()[1:]
+         while 1:
+            title,pos=m.line(pos)
+            if "#O"!=title[0:2]:
+               break;
+            names+=title.split()[1:]#Motor names, continued
+      idx.headers[key]=(geom,names)
+   return idx.headers[key]
+
+################################# parsed scans cache ###############################
+# folder of the cache of parsed scans, shared by all sessions
+SPEC_CACHE_DIR=os.environ.get("RSM_VIEWER_CACHE",os.path.join(os.path.expanduser("~"),".cache","RSM_Viewer","spec"))
+SPEC_CACHE_SIZE=512*1024*1024# bytes - the least recently used scans are removed above this size, 0 disables the cache
+SPEC_CACHE_TRIM=0.9# fraction of SPEC_CACHE_SIZE left after trimming, so that the folder is not listed at every insert
+_spec_cache_used={}# cache folder -> bytes used, counted by this process since the folder was last listed
+
+def _SpecCacheFile(m,idx,entry,columns):
+   """ cache file of a scan, named after the spec file path, the offset and size of the scan, the columns read,
+   and the bytes of the scan - header lines and data - so that a rewritten file does not hit entries of its
+   previous content. Hashing the scan costs much less than parsing it.
+   """
+   S,L,data,O,C,end,complete=entry
+   if columns is not None:columns=sorted(columns)
+   h=hashlib.sha1(repr((os.path.abspath(idx.fname),S,end-S,columns)))
+   h.update(m.block(S,end))
+   return os.path.join(SPEC_CACHE_DIR,h.hexdigest()+".pkl")
+
+def _SpecCacheLoad(fn):
+   try:
+      f=open(fn,'rb')
+      try:
+         headers,names,a=cPickle.load(f)
+      finally:
+         f.close()
+   except Exception:# missing or damaged entry
+      return None
+   try:
+      os.utime(fn,None)# recently used
+   except OSError:
+      pass
+   d={}
+   for j in xrange(len(names)):
+      d[names[j]]=a[j]
+   return headers,d
+
+def _SpecCacheStore(fn,headers,names,a):
+   try:
+      if not os.path.isdir(SPEC_CACHE_DIR):os.makedirs(SPEC_CACHE_DIR)
+      tmp="%s.%d.part"%(fn,os.getpid())
+      f=open(tmp,'wb')
+      cPickle.dump((headers,names,a),f,protocol=2)
+      size=f.tell()
+      f.close()
+      os.rename(tmp,fn)
+   except (IOError,OSError):
+      return
+   used=_spec_cache_used.get(SPEC_CACHE_DIR)
+   if used is None:# first insert of this process: the folder is listed once, other processes may share it
+      used=sum(size for mtime,size,fn in _SpecCacheEntries())
+   else:
+      used+=size
+   _spec_cache_used[SPEC_CACHE_DIR]=used
+   if used>SPEC_CACHE_SIZE:
+      SpecCacheTrim(int(SPEC_CACHE_SIZE*SPEC_CACHE_TRIM))
+
+def _SpecCacheEntries():
+   """ (mtime,size,file name) of the entries of the cache, least recently used first """
+   entries=[]
+   for name in os.listdir(SPEC_CACHE_DIR):
+      if not name.endswith(".pkl"):continue
+      fn=os.path.join(SPEC_CACHE_DIR,name)
+      try:
+         st=os.stat(fn)
+      except OSError:
+         continue
+      entries.append((st.st_mtime,st.st_size,fn))
+   entries.sort()
+   return entries
+
+def SpecCacheTrim(maxsize=None):
+   """ Remove the least recently used entries of the cache of parsed scans, until it is smaller than maxsize
+   (default: SPEC_CACHE_SIZE) """
+   if maxsize is None:maxsize=SPEC_CACHE_SIZE
+   entries=_SpecCacheEntries()
+   total=sum(size for mtime,size,fn in entries)
+   for mtime,size,fn in entries:
+      if total<=maxsize:break
+      try:
+         os.remove(fn)
+      except OSError:
+         pass
+      total-=size
+   _spec_cache_used[SPEC_CACHE_DIR]=total
+
+def _ReadSpecScan(m,idx,entry,columns,cache=True):
+   """ headers,d of the scan at the offsets entry of the SpecIndex idx, from the SpecFile m.
+   Complete scans are kept in the cache of parsed scans (see SPEC_CACHE_DIR), scans being recorded are not.
+   cache: False to neither read nor fill the cache
+   """
+   S,L,data,O,C,end,complete=entry
+   cachefile=None
+   if cache and SPEC_CACHE_SIZE>0 and complete:
+      cachefile=_SpecCacheFile(m,idx,entry,columns)
+      res=_SpecCacheLoad(cachefile)
+      if res is not None:
+         return res
+   headers={}
+   headers["geom"],names=_SpecFileHeaders(m,idx,O,C)
+   if names is not None:
+      headers["O"]=list(names)
+   title,pos=m.line(S)
    headers["S"]=title[2:]
    s="#L"
    coltit=0
-   while 1:
-      coltit=f.readline()
+   P=None
+   while pos<end:
+      coltit,pos=m.line(pos)
       if s == coltit[0:len(s)]:
          break;
       if len(coltit)==0:
          break;
-      if coltit[0:2]=="#D" or coltit[0:2]=="#G" or coltit[0:2]=="#Q":
+      if coltit[0:2]=="#D":
          coltit=coltit.split()
          headers[coltit[0][1:]]=coltit[1:]
-      if coltit[0:3]=="#P0":
-         headers["P"]=coltit.split()[1:]
-      else :
-         if coltit[0:2]=="#P":
-            headers["P"]+=coltit.split()[1:]
+      elif coltit[0:2]=="#G" or coltit[0:2]=="#Q":# numeric arrays, as used by SpecGeometry
+         coltit=coltit.split()
+         headers[coltit[0][1:]]=array(coltit[1:],float64)
+      elif coltit[0:3]=="#P0":
+         P=coltit.split()[1:]
+      elif coltit[0:2]=="#P":
+         P+=coltit.split()[1:]
+   if P is not None:# motor positions, in the order of headers["O"]
+      headers["P"]=array(P,float64)
+   if L<0:# aborted scan: no '#L' line, no data
+      coltit=[]
+   else:
+      coltit=coltit.split()[1:]
+   if columns is None:
+      keep=range(len(coltit))
+   else:
+      keep=[i for i in xrange(len(coltit)) if coltit[i] in columns]
+   if L<0:
+      a=zeros((0,0),float32)
+   else:
+      a=ParseSpecBlock(m.block(data,end),len(coltit),keep)
+   # one contiguous row per column: the columns are views, not copies
    d={}
-   coltit=coltit.split()
-   for i in xrange(1,len(coltit)):
-   	d[coltit[i]]=[]
-   while 1:
-      l=f.readline()
-      if len(l)<2:
-         break;
-      if l[0]=="#":continue
-      if l[0]=="@":
-         while l[-2]=='\\':l=f.readline()
-         continue
-      l=l.split()
-      for i in xrange(1,len(coltit)):
-         d[coltit[i]].append(float(l[i-1]))
-   nb=len(d[coltit[1]])
-   for i in xrange(1,len(coltit)):
-      a=zeros(nb,float32)
-      for j in xrange(nb):
-        a[j]=d[coltit[i]][j]
-      d[coltit[i]]=copy.deepcopy(a)
-   f.close()
+   for j in xrange(len(keep)):
+      d[coltit[keep[j]]]=a[j]
    # Transform #O and #P headers into a dictionnary of motor positions, *before* the beginning of the scan
    if headers.has_key("P") and headers.has_key("O"):
       if len(headers["P"])==len(headers["O"]):
          headers["motors"]={}
          for i in xrange(len(headers["P"])):
             headers["motors"][headers["O"][i]]=float(headers["P"][i])
+   if cachefile is not None:
+      _SpecCacheStore(cachefile,headers,[coltit[i] for i in keep],a)
    return headers,d
 
 def ReadSpecHKLMAD(fname,sn,fout="HKLMAD.dat",ycol="vct1_4",normcol="vct1_3",filtercol=None,filtercoeff=10.):
-   headers,d=ReadSpec(fname,sn[0])
+   scans=ReadSpecMany(fname,sn)
+   headers,d=scans[0]
    t=headers["S"]
    n=len(d["H"])
    ne=len(sn)
@@ -300,7 +719,7 @@ def ReadSpecHKLMAD(fname,sn,fout="HKLMAD.dat",ycol="vct1_4",normcol="vct1_3",fil
    a[:,1]=d["K"]
    a[:,2]=d["L"]
    for i in xrange(ne):
-      headers,d=ReadSpec(fname,sn[i])
+      headers,d=scans[i]
       t=headers["S"]
       a[:,3+i]=d[ycol]
       if (normcol!="") and (normcol!=None):
@@ -326,7 +745,8 @@ def ReadSpec2D(fname,sn,ix="H",iy="L",ycol="vct1_4",filtercol=None,filtercoeff=1
    from the original MCA data, using the optionnal [psdmin,psdmax] range
    
    """
-   headers,d=ReadSpec(fname,sn[0])
+   scans=ReadSpecMany(fname,sn)
+   headers,d=scans[0]
    t=headers["S"]
    nx=len(d[ix])
    ny=len(sn)
@@ -345,7 +765,7 @@ def ReadSpec2D(fname,sn,ix="H",iy="L",ycol="vct1_4",filtercol=None,filtercoeff=1
       x=ma.array(x,mask=a>1.0)
       y=ma.array(y,mask=a>1.0)
    for i in xrange(ny):
-      headers,d=ReadSpec(fname,sn[i])
+      headers,d=scans[i]
       t=headers["S"]
       nxtmp=len(d[ix])
       if mcabasename==None:
@@ -420,9 +840,202 @@ def ReadSpecMesh(fname,sn,ycol="vct1_4",filtercol=None,filtercoeff=10.,normcol=N
    y=y[:nx*ny]
    return a.reshape((ny,nx)),x.reshape((ny,nx)),y.reshape((ny,nx)),ix,iy
 
+################################# MCA spectra index ###############################
+MCA_INDEX_SUFFIX=".mcaidx" # sidecar file holding the index, next to the mca file
+MCA_INDEX_VERSION=1
+_mca_indexes={}            # absolute file name -> MCAIndex, indexes already loaded by this process
+
+class MCAIndex:
+   """ Byte offsets of the '@A' spectra of a mca file, built in a single pass over the file.
+   
+   spectra[i]=[scan,point,offset,length]: number of the last '#S' line before spectrum i (-1 if none),
+   index of the spectrum among those following that line, offset of the '@A' line and length of the
+   spectrum, continuation lines included.
+   maps[j]=[first,count]: spectra of map j, grouped as ReadMCA2D_complete always did: a map starts at a
+   '#S' line whose number of points (7th field) differs from the previous one, or once more spectra
+   than this number were read. Spectra before the first map are not part of any map.
+   The index is saved in fname+MCA_INDEX_SUFFIX, and rebuilt when the file changes.
+   Offsets of compressed files are offsets in the decompressed data.
+   """
+   def __init__(self,fname):
+      self.fname=fname
+      self.fsize=None# size and modification time of the file when indexed
+      self.mtime=None
+      self.spectra=[]
+      self.maps=[]
+      self.points={}# (scan,point) -> index in spectra
+   def valid(self,st=None):
+      if st is None:st=os.stat(self.fname)
+      return self.fsize==st.st_size and self.mtime==st.st_mtime
+   def _next_S(self,m,pos):
+      """ offset of the next '#S' line from pos, -1 if none """
+      if pos==0 and m.map[:2]=="#S":return 0
+      p=m.find("\n#S",max(pos-1,0))
+      return -1 if p<0 else p+1
+   def _next_A(self,m,pos):
+      """ offset of the next line whose first word is '@A' from pos, -1 if none """
+      size=len(m)
+      while True:
+         p=m.find("@A",pos)
+         if p<0:return -1
+         start=m.map.rfind("\n",0,p)+1
+         if not m.map[start:p].strip() and (p+2>=size or m.map[p+2].isspace()):return start
+         pos=p+2
+   def _end(self,m,start,end):
+      """ end of the spectrum starting at start, without the empty and '#' lines before end """
+      while True:
+         p=m.map.rfind("\n",start,end-1)+1
+         if p<=start:return end
+         l=m.map[p:end]
+         if l.strip() and l[0]!="#":return end
+         end=p
+   def build(self,st=None):
+      """ Index the file from the beginning. Only the '#S' and '@A' lines are read """
+      if st is None:st=os.stat(self.fname)
+      m=SpecFile(self.fname)
+      spectra=[]
+      maps=[[0,0]]
+      cur=None
+      scan,point=-1,0
+      count,npoints=0,0# '@A' lines since the beginning of the map, and number of points of the map
+      S,A=self._next_S(m,0),self._next_A(m,0)
+      while S>=0 or A>=0:
+         if A<0 or 0<=S<A:
+            l,end=m.line(S)
+            w=l.split()
+            n=int(w[6])
+            if n!=npoints or count>npoints:
+               if cur is not None:cur[3]=self._end(m,cur[2],S)-cur[2]
+               cur=None
+               maps.append([len(spectra),0])
+               count,npoints=0,n
+            try:
+               scan=int(w[1])
+            except ValueError:
+               scan=-1
+            point=0
+            S=self._next_S(m,end)
+         else:
+            l,end=m.line(A)
+            if cur is not None:cur[3]=self._end(m,cur[2],A)-cur[2]
+            cur=[scan,point,A,0]
+            spectra.append(cur)
+            maps[-1][1]+=1
+            count+=1
+            point+=1
+            A=self._next_A(m,end)
+      if cur is not None:cur[3]=self._end(m,cur[2],len(m))-cur[2]
+      m.close()
+      self.spectra=spectra
+      self.maps=maps[1:]
+      self.fsize,self.mtime=st.st_size,st.st_mtime
+      self._lookup()
+   def _lookup(self):
+      self.points={}
+      for i in xrange(len(self.spectra)-1,-1,-1):# the first spectrum wins if a scan number is used twice
+         self.points[tuple(self.spectra[i][:2])]=i
+   def load(self):
+      """ Read the sidecar file, whether it is up to date or not. Return False if it is missing """
+      try:
+         f=open(self.fname+MCA_INDEX_SUFFIX,'r')
+         d=json.load(f)
+         f.close()
+      except (IOError,ValueError):
+         return False
+      if d.get("version")!=MCA_INDEX_VERSION:
+         return False
+      self.fsize,self.mtime,self.spectra,self.maps=d["fsize"],d["mtime"],d["spectra"],d["maps"]
+      self._lookup()
+      return True
+   def save(self):
+      """ Write the sidecar file - silently skipped if the folder is read-only """
+      d={"version":MCA_INDEX_VERSION,"fsize":self.fsize,"mtime":self.mtime,"spectra":self.spectra,"maps":self.maps}
+      fn=self.fname+MCA_INDEX_SUFFIX
+      try:
+         f=open(fn+".part",'w')
+         json.dump(d,f)
+         f.close()
+         os.rename(fn+".part",fn)
+      except (IOError,OSError):
+         pass
+   def get(self,scan,point=0):
+      """ index in spectra of spectrum number point after the '#S scan' line """
+      if not self.points.has_key((scan,point)):
+         raise KeyError("Spectrum %i of scan #S %i not found in %s"%(point,scan,self.fname))
+      return self.points[(scan,point)]
+
+def GetMCAIndex(fname):
+   """ MCAIndex of a mca file, up to date: from memory or from its sidecar file, rebuilt if the file changed """
+   key=os.path.abspath(fname)
+   st=os.stat(fname)
+   idx=_mca_indexes.get(key)
+   if idx is None:
+      idx=MCAIndex(fname)
+      idx.load()
+      _mca_indexes[key]=idx
+   if not idx.valid(st):
+      idx.build(st)
+      idx.save()
+   return idx
+
+def _ParseMCASpectrum(text):
+   """ counts of a spectrum ('@A' line and continuation lines), with the rules of ReadMCA2D_complete """
+   counts=[]
+   lines=text.split("\n")
+   for i in xrange(len(lines)):
+      line=lines[i]
+      if i<len(lines)-1:line+="\n"
+      if not line.strip() or line.startswith("#"):continue
+      if line.split()[0]=="@A":
+         line=line[2:len(line)-2]
+      elif line[len(line)-2]=="\\":
+         line=line[:len(line)-2]
+      counts.extend(map(int,line.split()))
+   return counts
+
+def _ReadMCASpectra(m,idx,first,stop):
+   """ counts of the spectra first...stop-1 of the MCAIndex idx, read from the SpecFile m with one seek """
+   spectra=idx.spectra[first:stop]
+   if len(spectra)==0:return []
+   start=spectra[0][2]
+   text=str(m.block(start,spectra[-1][2]+spectra[-1][3]))
+   return [_ParseMCASpectrum(text[o-start:o-start+n]) for scan,point,o,n in spectra]
+
+def ReadMCASpectrum(filename,scan,point=0):
+   """ Read a single spectrum of a mca file: number point (default: the first one) after the '#S scan' line
+   return: 1D int array
+   """
+   idx=GetMCAIndex(filename)
+   i=idx.get(scan,point)
+   m=SpecFile(filename)
+   counts=_ReadMCASpectra(m,idx,i,i+1)[0]
+   m.close()
+   return np.asarray(counts)
+
+def ReadMCAPoints(filename,first,stop):
+   """ Read the spectra number first to stop-1 of a mca file, counting all the '@A' spectra of the file
+   return: 2D int array, one spectrum per line
+   """
+   idx=GetMCAIndex(filename)
+   m=SpecFile(filename)
+   counts=_ReadMCASpectra(m,idx,first,stop)
+   m.close()
+   return np.asarray(counts)
+
+def ReadMCAMap(filename,n):
+   """ Read map number n of a mca file, without reading the other maps
+   return: 2D int array, equal to ReadMCA2D_complete(filename)[n]
+   """
+   idx=GetMCAIndex(filename)
+   first,count=idx.maps[n]
+   m=SpecFile(filename)
+   counts=_ReadMCASpectra(m,idx,first,first+count)
+   m.close()
+   return np.asarray(counts)
+
 def ReadMCA(filename):
    #print "ReadMCA: reading %s"%filename
-   f=open(filename,'r')
+   f=xopen(filename)
    nb=0
    pointperline=16
    scan=zeros(1,'f')
@@ -453,7 +1066,7 @@ def ReadMCA(filename):
             break
    return scan
 
-def ReadMCA2D (mcabasename,scanid,specfilename,filtercol=None,filtercoeff=10.,normcol="Mon2",nrebin_mca=None,psdmin=None,psdmax=None):
+def ReadMCA2D (mcabasename,scanid,specfilename,filtercol=None,filtercoeff=10.,normcol="Mon2",nrebin_mca=None,psdmin=None,psdmax=None,spec=None):
    """ Read 2D MCA scan, rebin it and use Delaunay interpolation to obtain a representation along orthonormal coordinates.
    
        psdmin: first pixel included in the data (to avoid null regions on the borders)
@@ -464,9 +1077,13 @@ def ReadMCA2D (mcabasename,scanid,specfilename,filtercol=None,filtercoeff=10.,no
        
        Rebinning (numbers should be exact dividers of the recorded number of pixels):
          nrebin_mca: final number of desired pixel in the PSD direction
+       
+       spec: (headers,scan) of scanid if already read, e.g. by ReadSpecMany
    """
    scan2d=[]
-   headers,scan=ReadSpec(specfilename,scanid)
+   if spec is None:
+      spec=ReadSpec(specfilename,scanid)
+   headers,scan=spec
    title=headers["S"]
    norm=scan[normcol]
    if filtercol!=None:
@@ -495,53 +1112,13 @@ def ReadMCA2D (mcabasename,scanid,specfilename,filtercol=None,filtercoeff=10.,no
 
 def ReadMCA2D_complete(filename):
 	""" Read all carto in a single MCA file
-	return: scan3d --> numpy array of many 2D array. Each 2D array is a complete carto"""
-	f = open(filename, 'r')
-	scan3d   = []
-	scan2d   = []
-	scan1d   = []
-	compteur = 0
-	point_nb = 0
-	for line in f.readlines():
-		if not line.strip():
-			continue
-		else:
-			if line.startswith("#S"):
-				point_nb_actual = int(line.split()[6])
-				if point_nb_actual != point_nb or compteur>point_nb:
-					scan2d.append(scan1d)
-					scan3d.append(scan2d)
-					scan1d = []
-					scan2d = []
-					compteur = 0
-					point_nb = point_nb_actual
-			elif line.startswith("#"):
-				continue
-			else:
-				l = line.split()
-				if l[0]=="@A":
-					compteur = compteur+1
-					scan2d.append(scan1d)
-					scan1d = []
-					line = line[2:len(line)-2]
-					#print line
-					l = line.split()
-					for i in l:
-						scan1d.append(int(i))
-				else:
-					if line[len(line)-2]=="\\":
-						#print line
-						line = line[:len(line)-2]
-					#print "###"
-					#print line
-					l = line.split()
-					for i in l:
-						scan1d.append(int(i))
-	scan2d.append(scan1d) #dernier scan
-	scan3d.append(scan2d) #derniere carto
-	scan3d = scan3d[1:]
-	for i in range(len(scan3d)):
-		scan3d[i] = np.asarray(scan3d[i][1:])
+	return: scan3d --> numpy array of many 2D array. Each 2D array is a complete carto
+	The spectra are located with the MCAIndex of the file, see ReadMCAMap to read a single carto"""
+	idx = GetMCAIndex(filename)
+	f = SpecFile(filename)
+	scan3d = []
+	for first, count in idx.maps:
+		scan3d.append(np.asarray(_ReadMCASpectra(f, idx, first, first + count)))
 	scan3d = np.asarray(scan3d)
 	f.close()
 	return scan3d
@@ -631,7 +1208,7 @@ def Interp2d(x0,y0,z0,x1=None,y1=None,gridsize=None,nbknots=20,s=None,smargin=0.
    return y1,x1,z1,fpx+fpy
 
 
-def ReadMCA2DRebin(mcabasename,scanid,specfilename,filtercol=None,filtercoeff=10.,normcol="Mon2",nrebin_mca=None,psdmin=None,psdmax=None,psd0=None,psdPixelSizeOverDistance=None,psdor="out"):
+def ReadMCA2DRebin(mcabasename,scanid,specfilename,filtercol=None,filtercoeff=10.,normcol="Mon2",nrebin_mca=None,psdmin=None,psdmax=None,psd0=None,psdPixelSizeOverDistance=None,psdor="out",spec=None):
    """ Read 2D MCA scan, rebin it and use Delaunay interpolation to obtain a representation along orthonormal coordinates.
    
        psdmin: first pixel included in the data (to avoid null regions on the borders)
@@ -643,8 +1220,10 @@ def ReadMCA2DRebin(mcabasename,scanid,specfilename,filtercol=None,filtercoeff=10
        Rebinning (numbers should be exact dividers of the recorded number of pixels):
          nrebin_mca: final number of desired pixel in the PSD direction
          nrebin_x: final number of desired pixel in the x (non-PSD) direction. If 0 (default), no rebin is done
+       
+       spec: (headers,scan) of scanid if already read, e.g. by ReadSpecMany
    """
-   headers,s,s2d=ReadMCA2D(mcabasename,scanid,specfilename,filtercol=filtercol,filtercoeff=filtercoeff,normcol=normcol)
+   headers,s,s2d=ReadMCA2D(mcabasename,scanid,specfilename,filtercol=filtercol,filtercoeff=filtercoeff,normcol=normcol,spec=spec)
    if psdmin==None:
       psdmin=0
    if psdmax==None:
@@ -661,11 +1240,8 @@ def ReadMCA2DRebin(mcabasename,scanid,specfilename,filtercol=None,filtercoeff=10
          s2dr[:,i]=s2d[:,i*step:(i+1)*step].sum(axis=1)
          
    
-   g=SpecGeometry(headers)
+   g=SpecGeometry(headers,psd0=psd0,psdPixelSizeOverDistance=psdPixelSizeOverDistance,psdor=psdor)
    print specfilename, g.headers["S"]
-   g.psd0=psd0
-   g.psdPixelSizeOverDistance=psdPixelSizeOverDistance
-   g.psdor=psdor
    h,k,l=s2dr*0,s2dr*0,s2dr*0
    nx,ny=h.shape
    angles0=g.angles0
@@ -693,7 +1269,8 @@ def ReadMCA3DRebin(mcabasename,scanid,specfilename,filtercol=None,filtercoeff=10
          nrebin_mca: final number of desired pixel in the PSD direction
          nrebin_x: final number of desired pixel in the x (non-PSD) direction. If 0 (default), no rebin is done
    """
-   h0,k0,l0,s2dr0,g0,s0=ReadMCA2DRebin(mcabasename,scanid[0],specfilename,filtercol=filtercol,filtercoeff=filtercoeff,normcol=normcol,nrebin_mca=nrebin_mca,psdmin=psdmin,psdmax=psdmax,psd0=psd0,psdPixelSizeOverDistance=psdPixelSizeOverDistance,psdor=psdor)
+   specs=ReadSpecMany(specfilename,scanid)
+   h0,k0,l0,s2dr0,g0,s0=ReadMCA2DRebin(mcabasename,scanid[0],specfilename,filtercol=filtercol,filtercoeff=filtercoeff,normcol=normcol,nrebin_mca=nrebin_mca,psdmin=psdmin,psdmax=psdmax,psd0=psd0,psdPixelSizeOverDistance=psdPixelSizeOverDistance,psdor=psdor,spec=specs[0])
    n=len(scanid)
    if n==1:return h0,k0,l0,s2dr0,g0,s0
    h=zeros((n,s2dr0.shape[0],s2dr0.shape[1]),dtype=float32)
@@ -702,7 +1279,7 @@ def ReadMCA3DRebin(mcabasename,scanid,specfilename,filtercol=None,filtercoeff=10
    sr=zeros((n,s2dr0.shape[0],s2dr0.shape[1]),dtype=float32)
    h[0],k[0],l[0],sr[0]=h0,k0,l0,s2dr0
    for i in xrange(1,n):
-      h0,k0,l0,s2dr0,g0,s0=ReadMCA2DRebin(mcabasename,scanid[i],specfilename,filtercol=filtercol,filtercoeff=filtercoeff,normcol=normcol,nrebin_mca=nrebin_mca,psdmin=psdmin,psdmax=psdmax,psd0=psd0,psdPixelSizeOverDistance=psdPixelSizeOverDistance,psdor=psdor)
+      h0,k0,l0,s2dr0,g0,s0=ReadMCA2DRebin(mcabasename,scanid[i],specfilename,filtercol=filtercol,filtercoeff=filtercoeff,normcol=normcol,nrebin_mca=nrebin_mca,psdmin=psdmin,psdmax=psdmax,psd0=psd0,psdPixelSizeOverDistance=psdPixelSizeOverDistance,psdor=psdor,spec=specs[i])
       h[i],k[i],l[i],sr[i]=h0,k0,l0,s2dr0
    
    return h,k,l,sr,g0,s0
@@ -720,9 +1297,10 @@ def ReadSpecHKLMAD_MCA2D(mcabasename,sn,specfilename,fout="HKLMAD.dat",psdmin=No
          nrebin_mca: final number of desired pixel in the PSD direction
    """
    ne=len(sn)
+   specs=ReadSpecMany(specfilename,sn)
    h,k,l,d,g=[],[],[],[],[]
    for i in xrange(ne):
-      tmph,tmpk,tmpl,tmpd,tmpg,tmps=ReadMCA2DRebin(mcabasename,sn[i],specfilename,filtercol=filtercol,filtercoeff=filtercoeff,normcol=normcol,nrebin_mca=nrebin_mca,psdmin=psdmin,psdmax=psdmax,psd0=psd0,psdPixelSizeOverDistance=psdPixelSizeOverDistance,psdor=psdor)
+      tmph,tmpk,tmpl,tmpd,tmpg,tmps=ReadMCA2DRebin(mcabasename,sn[i],specfilename,filtercol=filtercol,filtercoeff=filtercoeff,normcol=normcol,nrebin_mca=nrebin_mca,psdmin=psdmin,psdmax=psdmax,psd0=psd0,psdPixelSizeOverDistance=psdPixelSizeOverDistance,psdor=psdor,spec=specs[i])
       h.append(tmph)
       k.append(tmpk)
       l.append(tmpl)
@@ -769,27 +1347,34 @@ def ReadMAD2D(fin="FTFAFNDPHI.dat.calc",npsd=None):
 def importXPADI0(specfiles=[],verbose =False):
   xpad_i0={}
   for specfile in specfiles:
-    ll=open(specfile,'r').readlines()
-    for i in xrange(len(ll)):
-      l=ll[i]
-      if l[:7]=="#XPADCT":
-        if len(ll)>(i+7):
-          l1=ll[i+6]
-          l2=ll[i+7]
-          if len(l2)>6:
-            if l1[:2]=="#L" and l2[:6]!="#ABORT":
-              l1=l1.split()[1:]
-              l2=l2.split()
-              d={}
-              for j in xrange(len(l1)):
-                k=l1[j]
-                v=l2[j]
-                if v.find('(')>=0: d[k]=float(l2[j].split('(')[0])
-                else: d[k]=float(l2[j])
-                imgname=l.split()[1].split(':')[1]+".txt"
-                if verbose:print imgname,d
-                i+=7
-                xpad_i0[imgname]=d
+    m=SpecFile(specfile)
+    pos=-1
+    while True:
+      pos=m.find("#XPADCT",pos+1)
+      if pos<0:break
+      if pos>0 and m.map[pos-1]!="\n":continue
+      l,p=m.line(pos)
+      ll=[]# the 7 lines following #XPADCT
+      while len(ll)<7 and p<len(m):
+        t,p=m.line(p)
+        ll.append(t)
+      if len(ll)==7:
+        l1=ll[5]
+        l2=ll[6]
+        if len(l2)>6:
+          if l1[:2]=="#L" and l2[:6]!="#ABORT":
+            l1=l1.split()[1:]
+            l2=l2.split()
+            d={}
+            for j in xrange(len(l1)):
+              k=l1[j]
+              v=l2[j]
+              if v.find('(')>=0: d[k]=float(l2[j].split('(')[0])
+              else: d[k]=float(l2[j])
+              imgname=l.split()[1].split(':')[1]+".txt"
+              if verbose:print imgname,d
+              xpad_i0[imgname]=d
+    m.close()
   return xpad_i0
 
 def XPADcalcFlatFieldDarkMask(dark,flat,medfilt_width=21):
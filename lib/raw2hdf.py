@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Headless batch conversion of Bruker RAW v3 files into the HDF5 layout
+# written by the RSM viewer (lab source tab), without any GTK import
+#
+# usage : as a script
+# python raw2hdf.py -s Si raw_folder [-o h5_folder]
+#
+# usage as a python module
+# from raw2hdf import batch_convert
+# batch_convert('raw_folder', 'h5_folder', substrate='Si')
+
+import os
+import sys
+import json
+import argparse
+import multiprocessing
+import numpy as np
+import h5py as h5
+import xrayutilities as xu
+from Bruker import get_Bruker_raw
+
+# sizes, mtimes and conversion settings of the RAW files converted by the last runs, kept in the destination folder
+MANIFEST = ".raw2hdf.json"
+
+def HKL2Q(H,K,L,a):
+	""" Q// est dans la direction [110], Qz // [001]"""
+	Qx = H*np.sqrt(2.)/a
+	Qy = K*np.sqrt(2.)/a
+	Qz = L/a
+	return [Qx, Qy, Qz]
+
+def raw_to_hdf(raw_file, h5_file, substrate="Si", in_plane=(1,1,0), out_of_plane=(0,0,1), energy=8048., HKL=None, description=None, experiment=None):
+	""" Convert one RAW file to HDF5 - the layout read by the RSM viewer, which also converts through this function.
+	substrate: name of a material of xrayutilities.materials, or the material itself
+	HKL: reflection used to correct the angular offset of the map (optional)
+	description: group name, defaults to the RAW file name without extension
+	experiment: xrayutilities experiment (e.g. HXRD) converting the angles, replaces in_plane, out_of_plane and energy
+	"""
+	if description is None:
+		description = os.path.splitext(os.path.basename(raw_file))[0]
+	material = getattr(xu.materials, substrate) if isinstance(substrate, basestring) else substrate
+	if experiment is None:
+		experiment = xu.HXRD(material.Q(in_plane), material.Q(out_of_plane), en=energy)
+	a = material._geta1()[0]/10. # in nm
+
+	dataset = get_Bruker_raw(raw_file)
+	Qhkl = experiment.Ang2HKL(dataset['omega'], dataset['tth'])
+	Qx,Qy,Qz = Qhkl[0],Qhkl[1],Qhkl[2]
+	########## Correction d'offset ###############
+	if HKL is not None:
+		i = np.argmax(dataset['data']) # flat index: the arrays are 1D when ranges are ragged
+		Qx = Qhkl[0]+HKL[0]-Qhkl[0].flat[i]
+		Qy = Qhkl[1]+HKL[1]-Qhkl[1].flat[i]
+		Qz = Qhkl[2]+HKL[2]-Qhkl[2].flat[i]
+	Q = HKL2Q(Qx, Qy, Qz, a)
+
+	# write next to the destination and rename, so an interrupted run leaves no half-written file
+	tmp_file = h5_file + ".part"
+	h5file = h5.File(tmp_file,"w")
+	s = h5file.create_group(description)
+	s.create_dataset('intensity', data=dataset['data'], compression='gzip', compression_opts=9)
+	s.create_dataset('Qx', data=Q[0], compression='gzip', compression_opts=9)
+	s.create_dataset('Qy', data=Q[1], compression='gzip', compression_opts=9)
+	s.create_dataset('Qz', data=Q[2], compression='gzip', compression_opts=9)
+	s.create_dataset('description', data=description)
+	if 'offsets' in dataset: # ranges with different numbers of steps, see Bruker.ragged_to_2d
+		s.create_dataset('offsets', data=dataset['offsets'])
+	h5file.close()
+	os.rename(tmp_file, h5_file)
+
+def _convert_one(job):
+	""" pool worker: returns (raw file name, error message or None) """
+	raw_file, h5_file, kwargs = job
+	try:
+		raw_to_hdf(raw_file, h5_file, **kwargs)
+		return os.path.basename(raw_file), None
+	except Exception as e:
+		return os.path.basename(raw_file), "%s: %s"%(type(e).__name__, e)
+
+def _stamp(path, settings):
+	""" manifest entry of a RAW file: [size, mtime, settings], settings as read back from json """
+	st = os.stat(path)
+	return [st.st_size, st.st_mtime, json.loads(json.dumps(settings, sort_keys=True, default=repr))]
+
+def load_manifest(dest):
+	try:
+		with open(os.path.join(dest, MANIFEST)) as f:
+			return json.load(f)
+	except (IOError, ValueError):
+		return {}
+
+def save_manifest(dest, manifest):
+	fn = os.path.join(dest, MANIFEST)
+	with open(fn + ".part", "w") as f:
+		json.dump(manifest, f, indent=1, sort_keys=True)
+	os.rename(fn + ".part", fn)
+
+def batch_convert(src, dest=None, processes=None, force=False, verbose=True, **kwargs):
+	""" Convert every .raw file of the folder src to dest/<name>.h5 using a process pool.
+	Files whose size and mtime did not change since they were last converted with the same settings
+	(and whose .h5 exists) are skipped, unless force is True. Other keyword arguments are passed to raw_to_hdf.
+	return: (converted, skipped, failed) lists of file names, failed as (name, error) tuples
+	"""
+	if dest is None:
+		dest = src
+	if not os.path.isdir(dest):
+		os.makedirs(dest)
+	manifest = {} if force else load_manifest(dest)
+	jobs, skipped = [], []
+	for name in sorted(os.listdir(src)):
+		raw_file = os.path.join(src, name)
+		if not (name.lower().endswith(".raw") and os.path.isfile(raw_file)):
+			continue
+		h5_file = os.path.join(dest, os.path.splitext(name)[0] + ".h5")
+		if manifest.get(name) == _stamp(raw_file, kwargs) and os.path.isfile(h5_file):
+			skipped.append(name)
+			continue
+		jobs.append((raw_file, h5_file, kwargs))
+
+	converted, failed = [], []
+	if jobs:
+		pool = multiprocessing.Pool(processes)
+		try:
+			for name, error in pool.imap_unordered(_convert_one, jobs):
+				if error is None:
+					converted.append(name)
+					manifest[name] = _stamp(os.path.join(src, name), kwargs)
+				else:
+					failed.append((name, error))
+					manifest.pop(name, None)
+				if verbose:
+					print "%s %s"%(name, "OK" if error is None else "FAILED (%s)"%error)
+		finally:
+			pool.close()
+			pool.join()
+			save_manifest(dest, manifest)
+	if verbose:
+		print "Total: %d converted, %d unchanged, %d failed"%(len(converted), len(skipped), len(failed))
+	return converted, skipped, failed
+
+def _indices(text):
+	return tuple(int(i) for i in text.split())
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Convert a folder of Bruker RAW v3 files to HDF5 (Qx, Qy, Qz, intensity)")
+	parser.add_argument("src", help="folder containing the .raw files")
+	parser.add_argument("-o", "--dest", help="output folder (default: src)")
+	parser.add_argument("-s", "--substrate", default="Si", help="substrate material in xrayutilities.materials (default: Si)")
+	parser.add_argument("--inplane", type=_indices, default=(1,1,0), help="in-plane direction, e.g. '1 1 0'")
+	parser.add_argument("--outplane", type=_indices, default=(0,0,1), help="out-of-plane direction, e.g. '0 0 1'")
+	parser.add_argument("-e", "--energy", type=float, default=8048., help="X-ray energy in eV (default: 8048)")
+	parser.add_argument("--hkl", type=_indices, default=None, help="substrate reflection for the offset correction, e.g. '0 0 4'")
+	parser.add_argument("-j", "--processes", type=int, default=None, help="number of worker processes (default: number of CPUs)")
+	parser.add_argument("-f", "--force", action="store_true", help="convert all files, even unchanged ones")
+	args = parser.parse_args(argv)
+	converted, skipped, failed = batch_convert(args.src, args.dest, processes=args.processes, force=args.force,
+		substrate=args.substrate, in_plane=args.inplane, out_of_plane=args.outplane, energy=args.energy, HKL=args.hkl)
+	return 1 if failed else 0
+
+if '__main__' == __name__:
+	sys.exit(main())
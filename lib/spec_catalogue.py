@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# SQLite catalogue of the scans of many SPEC files: scan number, '#S' command,
+# date, number of points, counters, geometry and motor positions before the scan,
+# updated incrementally from the scan index of each file (see mca_spec.SpecIndex).
+# Scans that cannot be parsed are listed in the errors table, and retried when the file changes
+#
+# usage : as a script
+# python spec_catalogue.py scans.db data/*.spec                 # add/update files
+# python spec_catalogue.py scans.db --type mesh --motor Eta 10 12 --path '%sampleX%'
+#
+# usage as a python module
+# from spec_catalogue import update_catalogue, find_scans
+# update_catalogue('scans.db', glob.glob('data/*.spec'))
+# find_scans('scans.db', type='mesh', path='%sampleX%', motors={'Eta': (10, 12)})
+
+import os
+import sys
+import sqlite3
+import argparse
+from mca_spec import GetSpecIndex, ReadSpecMany, ReadSpecParallel
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+	id INTEGER PRIMARY KEY,
+	path TEXT UNIQUE,
+	size INTEGER,
+	mtime REAL);
+CREATE TABLE IF NOT EXISTS scans (
+	id INTEGER PRIMARY KEY,
+	file_id INTEGER REFERENCES files(id),
+	number INTEGER,
+	offset INTEGER,
+	command TEXT,
+	type TEXT,
+	date TEXT,
+	points INTEGER,
+	counters TEXT,
+	geometry TEXT,
+	complete INTEGER,
+	UNIQUE (file_id, number));
+CREATE TABLE IF NOT EXISTS motors (
+	scan_id INTEGER REFERENCES scans(id),
+	name TEXT,
+	value REAL);
+CREATE TABLE IF NOT EXISTS errors (
+	file_id INTEGER REFERENCES files(id),
+	number INTEGER,
+	message TEXT);
+CREATE INDEX IF NOT EXISTS scans_type ON scans(type);
+CREATE INDEX IF NOT EXISTS motors_name_value ON motors(name, value);
+CREATE INDEX IF NOT EXISTS motors_scan ON motors(scan_id);
+"""
+
+# scans parsed at once when cataloguing a file
+BATCH = 200
+
+def open_catalogue(db):
+	""" sqlite3 connection to the catalogue db (file name), created if needed """
+	con = sqlite3.connect(db)
+	con.executescript(SCHEMA)
+	return con
+
+def _delete_scans(con, scan_ids):
+	for i in scan_ids:
+		con.execute("DELETE FROM motors WHERE scan_id=?", (i,))
+		con.execute("DELETE FROM scans WHERE id=?", (i,))
+
+def _add_scan(con, file_id, number, entry, headers, d):
+	words = headers["S"].split()
+	counters = sorted(d.keys())
+	points = len(d[counters[0]]) if counters else 0
+	cur = con.execute("INSERT INTO scans (file_id, number, offset, command, type, date, points, counters, geometry, complete) VALUES (?,?,?,?,?,?,?,?,?,?)",
+		(file_id, number, entry[0], " ".join(words[1:]), words[1] if len(words) > 1 else "",
+		" ".join(headers.get("D", [])), points, " ".join(counters), headers["geom"], entry[6]))
+	scan_id = cur.lastrowid
+	con.executemany("INSERT INTO motors (scan_id, name, value) VALUES (?,?,?)",
+		[(scan_id, name, value) for name, value in headers.get("motors", {}).items()])
+
+def _read_scan(path, number):
+	""" (headers, d) of one scan, or the error message if it cannot be parsed """
+	try:
+		return ReadSpecMany(path, [number], cache=False)[0]
+	except Exception as e:
+		return "%s: %s"%(type(e).__name__, e)
+
+def catalogue_file(con, fn, processes=1):
+	""" Add the scans of fn to the catalogue, or only the new and incomplete ones if it is already there.
+	A scan that cannot be parsed does not stop the others: it is recorded in the errors table instead.
+	return: (number of scans added, {scan number: error message})
+	"""
+	path = os.path.abspath(fn)
+	st = os.stat(path)
+	row = con.execute("SELECT id, size, mtime FROM files WHERE path=?", (path,)).fetchone()
+	if row is not None and row[1] == st.st_size and row[2] == st.st_mtime:
+		return 0, {}
+	idx = GetSpecIndex(path)
+	if row is None:
+		file_id = con.execute("INSERT INTO files (path) VALUES (?)", (path,)).lastrowid
+		known = {}
+	else:
+		file_id = row[0]
+		known = dict((r[0], r[1:]) for r in con.execute("SELECT number, id, offset, complete FROM scans WHERE file_id=?", (file_id,)))
+		if any(not idx.scans.has_key(n) or idx.scans[n][0] != offset for n, (i, offset, complete) in known.items()):
+			# not only appended to: start again
+			_delete_scans(con, [i for i, offset, complete in known.values()])
+			known = {}
+	# scans recorded since the last update, or still being recorded at that time
+	todo = [n for n in idx.order if n not in known or not known[n][2]]
+	_delete_scans(con, [known[n][0] for n in todo if n in known])
+	con.execute("DELETE FROM errors WHERE file_id=?", (file_id,))
+	added, failed = 0, {}
+	for i in xrange(0, len(todo), BATCH):
+		numbers = todo[i:i + BATCH]
+		try:
+			scans = ReadSpecParallel(path, numbers, processes=processes, cache=False)
+		except Exception:
+			# one bad scan fails its whole batch: read this batch scan by scan
+			scans = [_read_scan(path, n) for n in numbers]
+		for n, scan in zip(numbers, scans):
+			if not isinstance(scan, str):
+				try:
+					_add_scan(con, file_id, n, idx.scans[n], *scan)
+					added += 1
+					continue
+				except Exception as e:
+					scan = "%s: %s"%(type(e).__name__, e)
+			failed[n] = scan
+			con.execute("INSERT INTO errors (file_id, number, message) VALUES (?,?,?)", (file_id, n, scan))
+	# size of the file on disk, not idx.size (bytes indexed): they differ for compressed files and files being written
+	con.execute("UPDATE files SET size=?, mtime=? WHERE id=?", (idx.fsize, idx.mtime, file_id))
+	con.commit()
+	return added, failed
+
+def update_catalogue(db, files, processes=1, verbose=True):
+	""" Add or update the SPEC files in the catalogue db. Unchanged files are skipped,
+	grown files only have their new scans added (see catalogue_file).
+	return: {file name: number of scans added, or error message}, see the errors table for the scans that failed
+	"""
+	con = open_catalogue(db)
+	done = {}
+	try:
+		for fn in files:
+			failed = {}
+			try:
+				done[fn], failed = catalogue_file(con, fn, processes)
+			except Exception as e:
+				con.rollback()
+				done[fn] = "%s: %s"%(type(e).__name__, e)
+			if verbose:
+				print "%s: %s"%(fn, done[fn] if isinstance(done[fn], str) else "%d scans added, %d failed"%(done[fn], len(failed)))
+				for n in sorted(failed):
+					print "  #S %d: %s"%(n, failed[n])
+	finally:
+		con.close()
+	return done
+
+def find_scans(db, type=None, path=None, motors=None, complete=None):
+	""" Scans of the catalogue db matching all the given criteria:
+	type: scan command, e.g. 'mesh' or 'ascan'
+	path: SQL LIKE pattern on the absolute path of the SPEC file, e.g. '%sampleX%'
+	motors: {motor name: (min, max)} on the motor positions before the scan
+	complete: True/False to select finished or running scans
+	return: list of (path, scan number, command, date, points)
+	"""
+	sql = "SELECT f.path, s.number, s.command, s.date, s.points FROM scans s JOIN files f ON s.file_id=f.id"
+	where, args = [], []
+	if type is not None:
+		where.append("s.type=?")
+		args.append(type)
+	if path is not None:
+		where.append("f.path LIKE ?")
+		args.append(path)
+	if complete is not None:
+		where.append("s.complete=?")
+		args.append(int(complete))
+	for name, (vmin, vmax) in (motors or {}).items():
+		where.append("s.id IN (SELECT scan_id FROM motors WHERE name=? AND value BETWEEN ? AND ?)")
+		args += [name, vmin, vmax]
+	if where:
+		sql += " WHERE " + " AND ".join(where)
+	sql += " ORDER BY f.path, s.offset"
+	con = open_catalogue(db)
+	try:
+		return con.execute(sql, args).fetchall()
+	finally:
+		con.close()
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Catalogue the scans of SPEC files in a SQLite database, or query it")
+	parser.add_argument("db", help="catalogue file (created if needed)")
+	parser.add_argument("files", nargs="*", help="SPEC files to add or update")
+	parser.add_argument("-j", "--processes", type=int, default=1, help="number of worker processes parsing the scans (default: 1)")
+	parser.add_argument("--type", help="query: scan command, e.g. mesh")
+	parser.add_argument("--path", help="query: SQL LIKE pattern on the file path, e.g. '%%sampleX%%'")
+	parser.add_argument("--motor", nargs=3, action="append", metavar=("NAME", "MIN", "MAX"), help="query: motor position range before the scan (can be repeated)")
+	args = parser.parse_args(argv)
+	if args.files:
+		done = update_catalogue(args.db, args.files, args.processes)
+		if any(isinstance(v, str) for v in done.values()):
+			return 1
+	if args.type or args.path or args.motor:
+		motors = dict((name, (float(vmin), float(vmax))) for name, vmin, vmax in (args.motor or []))
+		for path, number, command, date, points in find_scans(args.db, args.type, args.path, motors):
+			print "%s #S %d  %s  (%d points, %s)"%(path, number, command, points, date)
+	return 0
+
+if '__main__' == __name__:
+	sys.exit(main())
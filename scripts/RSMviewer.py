@@ -26,6 +26,8 @@ import xrayutilities as xu
 from lmfit import Parameters, minimize
 import h5py as h5
 from RSM_Viewer import mca_spec as SP
+from RSM_Viewer import formats
+from RSM_Viewer import raw2hdf
 
 __version__ = "1.1.7"
 __date__ = "05/11/2014"
@@ -959,9 +961,15 @@ class MyMainWindow(gtk.Window):
 		self.Qy  = self.scan.get('Qy').value
 		self.Qz  = self.scan.get('Qz').value
 		self.rsm_description = self.scan.get('description').value
+		if self.data.ndim == 1:
+			# ragged Bruker ranges: points of all ranges concatenated, range i is offsets[i]:offsets[i+1]
+			offsets = self.scan.get('offsets').value
+			grid_shape = (len(offsets)-1, np.diff(offsets).max())
+		else:
+			grid_shape = self.data.shape
 		self.rsm_info.close()
 		#print "Data are successfully loaded."
-		self.gridder = xu.Gridder2D(self.data.shape[0],self.data.shape[1])
+		self.gridder = xu.Gridder2D(grid_shape[0],grid_shape[1])
 		#print "Gridder is calculated."
 #		MM  = self.data.max()
 #		M = np.log10(MM)
@@ -1074,7 +1082,7 @@ class MyMainWindow(gtk.Window):
 			folder = folder.decode('utf8')
 			folder_basename = folder.split("/")[-1]
 			#print folder_basename
-			self.store= [i for i in listdir(folder) if isfile(join(folder,i)) and i.endswith(".data") or i.endswith(".h5")]
+			self.store= self.list_rsm_files(folder)
 			self.GUI_current_folder = folder
 			#print store
 			if len(self.store)>0:
@@ -1088,10 +1096,16 @@ class MyMainWindow(gtk.Window):
 			pass
 		dialog.destroy()
 
+	def list_rsm_files(self, folder):
+		# converted maps are recognised from their content (HDF5 signature), not their extension
+		files = formats.classify_folder(folder, ["hdf5"]).get("hdf5", [])
+		files += [i for i in listdir(folder) if i.endswith(".data") and isfile(join(folder,i)) and i not in files]
+		return sorted(files)
+
 	def folder_update(self, w):
 		folder = self.GUI_current_folder
 		if folder is not os.getcwd():
-			store= [i for i in listdir(folder) if isfile(join(folder,i)) and i.endswith(".data") or i.endswith(".h5")]
+			store= self.list_rsm_files(folder)
 			self.store=[]
 			self.list_store.clear()
 			for i in store:
@@ -1511,10 +1525,7 @@ class MyMainWindow(gtk.Window):
 	
 	def HKL2Q(self,H,K,L,a):
 		""" Q// est dans la direction [110], Qz // [001]"""
-		Qx = H*np.sqrt(2.)/a
-		Qy = K*np.sqrt(2.)/a
-		Qz = L/a
-		return [Qx, Qy, Qz]
+		return raw2hdf.HKL2Q(H, K, L, a)
 	
 	def loadAmap(self,scanid,specfile,mapData,retard):
 		try:
@@ -1539,7 +1550,7 @@ class MyMainWindow(gtk.Window):
 			foil_col    = self.e4_entry.get_text()
 			monitor_ref = float(self.e6_entry.get_text())
 			#****************** Calculation ************************
-			headers, scan_kappa = SP.ReadSpec(specfile,scanid)
+			headers, scan_kappa = SP.ReadSpec(specfile,scanid,columns=['Eta',monitor_col,foil_col])
 			Eta = scan_kappa['Eta']
 			print Eta.shape
 			tth = headers['P'][0]
@@ -1746,60 +1757,18 @@ class MyMainWindow(gtk.Window):
 	def Bruker2HDF(self):
 		try:
 			raw_file = self.spec_file
-			from MCA_GUI.Bruker import convert_raw_to_uxd,get_Bruker
-			uxd_file = raw_file.split(".")[0]+".uxd"
-			convert_raw_to_uxd(raw_file, uxd_file)
 			
 			description = self.XRDML_description.get_text()
-			
-			self.XRDML_show_info.set_text("Reading Raw data ...")
-			self.gtk_waiting()
-
-			a    = self.substrate._geta1()[0] #in Angstrom
-			a    = a/10.
-			dataset = get_Bruker(uxd_file)
-			theta   = dataset['omega']
-			dTheta  = dataset['tth']
-			Qhkl    = self.experiment.Ang2HKL(theta, dTheta)
-			Qx,Qy,Qz = Qhkl[0],Qhkl[1],Qhkl[2]
-			########## Correction d'offset ###############
-			if self.offset_correction:
-				x,y=np.unravel_index(np.argmax(dataset['data']),dataset['data'].shape)
-				Hsub = Qhkl[0][x,y]
-				Ksub = Qhkl[1][x,y]
-				Lsub = Qhkl[2][x,y]
-				Qx = Qhkl[0]+self.HKL[0]-Hsub
-				Qy = Qhkl[1]+self.HKL[1]-Ksub
-				Qz = Qhkl[2]+self.HKL[2]-Lsub
-			
-			Q = self.HKL2Q(Qx, Qy, Qz, a)
-			self.XRDML_show_info.set_text("Raw data are successfully loaded.")
-			self.gtk_waiting()
-			
 			if description == "":
-				no_description = True
 				description = "RSM"
-			else:
-				no_description = False
 			
 			h5file = description+".h5"
-			info = "\nSaving file: %s"%(h5file)
+			info = "Reading Raw data ...\nSaving file: %s"%(h5file)
 			self.XRDML_show_info.set_text(info)
 			self.gtk_waiting()
-			h5file     = join(self.des_folder,h5file)
-			if os.path.isfile(h5file):
-				del_file = "rm -f %s"%h5file
-				os.system(del_file)
-			h5file     = h5.File(h5file,"w")
-			
-			s = h5file.create_group(description)
-			s.create_dataset('intensity', data=dataset['data'], compression='gzip', compression_opts=9)
-			s.create_dataset('Qx', data=Q[0], compression='gzip', compression_opts=9)
-			s.create_dataset('Qy', data=Q[1], compression='gzip', compression_opts=9)
-			s.create_dataset('Qz', data=Q[2], compression='gzip', compression_opts=9)
-			s.create_dataset('description', data=description)
-		
-			h5file.close()
+			# same conversion as the raw2hdf batch script
+			raw2hdf.raw_to_hdf(raw_file, join(self.des_folder,h5file), substrate=self.substrate, experiment=self.experiment,
+				HKL=self.HKL if self.offset_correction else None, description=description)
 			
 			self.popup_info("info","Data conversion completed!")
 		except:
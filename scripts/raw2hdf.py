@@ -0,0 +1,8 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Batch conversion of a folder of Bruker RAW files to HDF5, see RSM_Viewer.raw2hdf
+import sys
+from RSM_Viewer.raw2hdf import main
+
+if __name__=="__main__":
+	sys.exit(main())
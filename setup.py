@@ -14,10 +14,10 @@ name = 'RSM_Viewer'
 packages = ['']
 
 # Modules (files in lib/)
-modules = ['mca_spec', 'Bruker']
+modules = ['mca_spec', 'Bruker', 'formats', 'raw2hdf', 'spec_catalogue', 'compressed']
 
 # Scripts (in scripts/)
-scripts = ['RSMviewer.py']
+scripts = ['RSMviewer.py', 'raw2hdf.py']
 
 cmdclass = {}
 command_options = {}